@@ -4,28 +4,49 @@ monkey.patch_all()
 
 # Standard library imports
 import os
+import sys
 import uuid
 import time
 import io
 import json 
 import base64
-from datetime import datetime, timezone
-from functools import wraps
+import bisect
+import threading
+import queue
+import hashlib
+import hmac
+import tempfile
+import logging
+import random
+import atexit
+import contextvars
+from collections import OrderedDict, defaultdict
+from datetime import datetime, timedelta, timezone
+from contextlib import contextmanager
+from functools import wraps, cached_property
 from flask import g # <--- ДОБАВЬ ЭТУ СТРОКУ
 from flask_cors import CORS # <--- ДОБАВЬ ЭТУ СТРОКУ
 
 # Third-party imports
-import boto3
-import openai
+import click
+import gevent
+from gevent.threadpool import ThreadPool
 import requests
-import stripe
-import replicate
-from flask import Flask, request, jsonify, render_template, url_for, redirect, flash, session, get_flashed_messages
+from flask import Flask, request, jsonify, render_template, url_for, redirect, flash, session, get_flashed_messages, Response, stream_with_context, abort, make_response
 from flask_sqlalchemy import SQLAlchemy
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 from PIL import Image
 from werkzeug.datastructures import FileStorage
+from werkzeug.exceptions import HTTPException
+from werkzeug.local import LocalProxy
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.util import identity_key
+from sqlalchemy.schema import CreateIndex
 
 # --- Настройки приложения ---
 app = Flask(__name__)
@@ -46,21 +67,83 @@ AWS_ACCESS_KEY_ID = os.environ.get('AWS_ACCESS_KEY_ID')
 AWS_SECRET_ACCESS_KEY = os.environ.get('AWS_SECRET_ACCESS_KEY')
 AWS_S3_BUCKET_NAME = os.environ.get('AWS_S3_BUCKET_NAME')
 AWS_S3_REGION = os.environ.get('AWS_S3_REGION')
-
-stripe.api_key = os.environ.get('STRIPE_SECRET_KEY')
+S3_MAX_POOL_CONNECTIONS = int(os.environ.get('S3_MAX_POOL_CONNECTIONS', 50))
+S3_MAX_CONCURRENCY = int(os.environ.get('S3_MAX_CONCURRENCY', 4))
+S3_MULTIPART_THRESHOLD = int(os.environ.get('S3_MULTIPART_THRESHOLD_MB', 8)) * 1024 * 1024
+S3_MULTIPART_CHUNKSIZE = int(os.environ.get('S3_MULTIPART_CHUNKSIZE_MB', 8)) * 1024 * 1024
+S3_MIN_PART_SIZE = 5 * 1024 * 1024  # минимальный размер части multipart upload в S3
+S3_KNOWN_OBJECTS_INDEX_SIZE = 10000  # сколько ключей uploads/<sha256> помнить без HEAD-запроса
+REPLICATE_DOWNLOAD_CHUNK_SIZE = 256 * 1024
+REPLICATE_DOWNLOAD_TIMEOUT = (10, 60)  # (connect, read) в секундах
+INGEST_QUEUE_KEY = 'pifly_ingest_jobs'
+INGEST_LOCK_PREFIX = 'pifly_ingest_lock:'
+INGEST_LOCK_TTL = 300
+INGEST_MAX_ATTEMPTS = 3
+INGEST_CONSUMER_MODE = os.environ.get('INGEST_CONSUMER_MODE', 'embedded')  # embedded | external
+RESULT_CHANNEL_PREFIX = 'pifly_results:'
+RESULT_STREAM_MAX_IDS = 10
+RESULT_STREAM_MAX_SECONDS = 300  # потом EventSource сам переподключится
+RESULT_STREAM_HEARTBEAT_SECONDS = 15
+REPLICATE_API_URL = 'https://api.replicate.com/v1'
+REPLICATE_STATUS_CACHE_PREFIX = 'pifly_replicate_status:'
+REPLICATE_STATUS_TTL = int(os.environ.get('REPLICATE_STATUS_TTL', 10))
+REPLICATE_RECONCILE_INTERVAL = int(os.environ.get('REPLICATE_RECONCILE_INTERVAL', 5))
+REPLICATE_RECONCILE_BATCH_SIZE = 100
+REPLICATE_LIST_MAX_PAGES = 3
+REPLICATE_POLL_RATE_PER_SECOND = float(os.environ.get('REPLICATE_POLL_RATE_PER_SECOND', 5))
+REPLICATE_POLL_BURST = 10
+STAGE_TIMEOUT_SECONDS = int(os.environ.get('STAGE_TIMEOUT_SECONDS', 60))
+IMAGE_POOL_SIZE = int(os.environ.get('IMAGE_POOL_SIZE', 2))
+IMAGE_POOL_MAX_PENDING = int(os.environ.get('IMAGE_POOL_MAX_PENDING', 16))
+IMAGE_POOL_ACQUIRE_TIMEOUT = 5
+API_TOKEN_CACHE_MAX_ENTRIES = 5000
+API_TOKEN_EXPIRY_SKEW_SECONDS = 30
+USER_CACHE_PREFIX = 'pifly_user:'
+USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL', 60))
+USER_CACHE_VERSION_PREFIX = 'pifly_user_version:'
+USER_CACHE_VERSION_TTL = 24 * 3600  # с запасом дольше любого чтения между промахом и записью в кэш
+WEBHOOK_DEDUP_PREFIX = 'pifly_webhook_seen:'
+WEBHOOK_DEDUP_TTL = 7 * 24 * 3600
+WEBHOOK_DEDUP_PURGE_BATCH_SIZE = 1000
+EDIT_QUEUE_PREFIX = 'pifly_edit_jobs:'
+EDIT_QUEUE_LEGACY_KEY = 'pifly_edit_jobs'  # список, который внешний воркер читает через BRPOP
+# legacy - только старый список; dual - старый список и очереди по планам; claim - только /worker/jobs/claim
+EDIT_QUEUE_MODE = os.environ.get('EDIT_QUEUE_MODE', 'legacy')
+EDIT_QUEUE_LANES = ('pro', 'best', 'taste', 'free')  # порядок = приоритет выдачи воркеру
+EDIT_QUEUE_VISIBILITY_TIMEOUT = int(os.environ.get('EDIT_QUEUE_VISIBILITY_TIMEOUT', 300))
+EDIT_QUEUE_MAX_ATTEMPTS = 3
+EDIT_QUEUE_SWEEP_INTERVAL = 15
+EDIT_QUEUE_CLAIM_MAX_WAIT = 20
+PREDICTION_REAPER_INTERVAL = 300
+PREDICTION_REAPER_MIN_AGE = int(os.environ.get('PREDICTION_REAPER_MIN_AGE', 15 * 60))  # секунд без вебхука
+PREDICTION_REAPER_HARD_TIMEOUT = int(os.environ.get('PREDICTION_REAPER_HARD_TIMEOUT', 60 * 60))
+PREDICTION_REAPER_BATCH_SIZE = 100
+PREDICTION_REAPER_MODE = os.environ.get('PREDICTION_REAPER_MODE', 'embedded')  # embedded | external
+ARCHIVE_PAGE_SIZE = 30
+THUMBNAIL_MAX_DIMENSION = 512
+THUMBNAIL_MAX_SOURCE_BYTES = int(os.environ.get('THUMBNAIL_MAX_SOURCE_BYTES', 64 * 1024 * 1024))
+THUMBNAIL_MAX_SOURCE_PIXELS = int(os.environ.get('THUMBNAIL_MAX_SOURCE_PIXELS', 40_000_000))
+THUMBNAIL_BACKFILL_BATCH_SIZE = 200
+PROMPT_CACHE_PREFIX = 'pifly_prompt_cache:'
+PROMPT_CACHE_VERSION = 1
+PROMPT_CACHE_TTL = int(os.environ.get('PROMPT_CACHE_TTL', 7 * 24 * 3600))
+PROMPT_CACHE_LOCAL_ENTRIES = 1024
+
+STRIPE_SECRET_KEY = os.environ.get('STRIPE_SECRET_KEY')
 STRIPE_WEBHOOK_SECRET = os.environ.get('STRIPE_WEBHOOK_SECRET')
 REPLICATE_API_TOKEN = os.environ.get('REPLICATE_API_TOKEN')
 APP_BASE_URL = os.environ.get('APP_BASE_URL')
 WORKER_SECRET_KEY = os.environ.get('WORKER_SECRET_KEY')
 OPENAI_API_KEY = os.environ.get('OPENAI_API_KEY')
 REDIS_URL = os.environ.get('REDIS_URL')
-
-import redis # <--- ДОБАВЬТЕ ЭТУ СТРОКУ
-if REDIS_URL: # <--- ДОБАВЬТЕ ЭТИ 4 СТРОКИ
-    redis_client = redis.from_url(REDIS_URL)
-else:
-    redis_client = None
-    print("!!! ВНИМАНИЕ: REDIS_URL не найден. Отправка задач в воркер не будет работать.")
+BACKEND_MODE = os.environ.get('BACKEND_MODE', 'live')  # live | local (заглушки из local_backends.py)
+# Секретный файл на Render и файл для локальной разработки в корне проекта
+FIREBASE_CREDENTIAL_PATHS = ('/etc/secrets/firebase_credentials.json', 'firebase_credentials.json')
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', 0.1))  # доля сохраняемых записей с sampled=True
+LOG_QUEUE_MAX = 10000
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')  # /metrics отвечает только с Authorization: Bearer <token>; без токена - 404
+SERVICES_PREWARM = os.environ.get('SERVICES_PREWARM', '')  # '' | 'all' | 'redis,openai,...'
 
 PLAN_PRICES = {
     'taste': 'price_1RYA1GEAARFPkzEzyWSV75UE',
@@ -78,29 +161,391 @@ login_manager.login_view = 'login'
 login_manager.login_message = "Please log in to access this page."
 login_manager.login_message_category = "info"
 
-if OPENAI_API_KEY:
-    openai_client = openai.OpenAI(api_key=OPENAI_API_KEY)
-else:
-    openai_client = None
-    print("!!! ВНИМАНИЕ: OPENAI_API_KEY не найден. Улучшение промптов и Autofix не будут работать.")
-
-import firebase_admin
-from firebase_admin import credentials, auth
-
-# Путь к секретному файлу на Render
-cred_path = '/etc/secrets/firebase_credentials.json'
-if os.path.exists(cred_path):
-    cred = credentials.Certificate(cred_path)
-else:
-    # Для локальной разработки, положите файл в корень проекта
-    if os.path.exists('firebase_credentials.json'):
-        cred = credentials.Certificate('firebase_credentials.json')
+# --- Логирование ---
+_log_context = contextvars.ContextVar('pifly_log_context', default={})
+_LOG_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'sampled', 'context'}
+
+
+@contextmanager
+def log_context(**fields):
+    """Поля (prediction_id, replicate_id, ...), которые попадут во все записи внутри блока."""
+    token = _log_context.set({**_log_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _log_context.reset(token)
+
+
+def bind_log_context(**fields):
+    """Добавляет поля в контекст логирования до конца текущего запроса."""
+    _log_context.set({**_log_context.get(), **fields})
+
+
+class _LogContextFilter(logging.Filter):
+    """Выполняется в вызывающем greenlet'е: сэмплирует и запоминает контекст запроса."""
+
+    def filter(self, record):
+        if getattr(record, 'sampled', False) and random.random() >= LOG_SAMPLE_RATE:
+            return False
+        record.context = _log_context.get()
+        return True
+
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname.lower(),
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        entry.update(getattr(record, 'context', {}))
+        entry.update({key: value for key, value in vars(record).items() if key not in _LOG_RECORD_ATTRS})
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class AsyncLogHandler(logging.Handler):
+    """Обработчик, который пишет в stdout из отдельного системного потока.
+
+    Запрос только кладет запись в очередь. Форматирование и запись в stdout идут
+    в настоящем потоке ОС, а не в greenlet'е, поэтому медленный stdout не
+    останавливает цикл gevent. Очередь и поток берутся в исходном виде, до
+    monkey-patching. Если очередь переполнена, запись отбрасывается и
+    учитывается в dropped.
+
+    Поток запускается на первой записи, а после fork (gunicorn --preload) дочерний
+    процесс получает новую очередь и свой поток: поток родителя при fork не копируется.
+    """
+
+    def __init__(self, stream, max_queue):
+        super().__init__()
+        self._stream = stream
+        self._max_queue = max_queue
+        self.dropped = 0
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset)
+        atexit.register(self.drain)
+
+    def _reset(self):
+        # Записи родителя в очереди допишет сам родитель; блокировки могли остаться захваченными его потоками
+        self._queue = monkey.get_original('queue', 'SimpleQueue')()
+        self._write_lock = monkey.get_original('threading', 'Lock')()
+        self._start_lock = monkey.get_original('threading', 'Lock')()
+        self._writer_pid = None
+
+    def _ensure_writer(self):
+        pid = os.getpid()
+        if self._writer_pid == pid:
+            return
+        with self._start_lock:
+            if self._writer_pid != pid:
+                if self._writer_pid is not None:
+                    # fork без register_at_fork: очередь родителя не наша
+                    self._queue = monkey.get_original('queue', 'SimpleQueue')()
+                monkey.get_original('_thread', 'start_new_thread')(self._run, (self._queue,))
+                self._writer_pid = pid
+
+    def emit(self, record):
+        try:
+            self._ensure_writer()
+            if self._queue.qsize() >= self._max_queue:
+                self.dropped += 1
+                return
+            if record.exc_info:
+                # Трейсбек форматируем здесь: объекты кадров не передаем в другой поток
+                record.exc_text = record.exc_text or logging.Formatter().formatException(record.exc_info)
+                record.exc_info = None
+            self._queue.put(record)
+        except Exception:
+            self.handleError(record)
+
+    def _write(self, records):
+        lines = []
+        for record in records:
+            try:
+                lines.append(self.format(record))
+            except Exception:
+                lines.append(json.dumps({'level': 'error', 'msg': 'Unformattable log record', 'logger': record.name}))
+        with self._write_lock:
+            try:
+                self._stream.write('\n'.join(lines) + '\n')
+                self._stream.flush()
+            except Exception:
+                pass
+
+    def _run(self, log_queue):
+        while True:
+            records = [log_queue.get()]
+            while log_queue.qsize() and len(records) < 500:
+                records.append(log_queue.get())
+            self._write(records)
+
+    def drain(self):
+        records = []
+        while self._queue.qsize():
+            records.append(self._queue.get())
+        if records:
+            self._write(records)
+
+
+def configure_logging():
+    handler = AsyncLogHandler(sys.stdout, LOG_QUEUE_MAX)
+    handler.setFormatter(JsonLogFormatter())
+    handler.addFilter(_LogContextFilter())
+    logger = logging.getLogger('pifly')
+    logger.addHandler(handler)
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+    return logger
+
+
+log = configure_logging()
+
+
+@app.before_request
+def _bind_request_log_context():
+    g.request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex
+    g._log_context_token = _log_context.set({'request_id': g.request_id, 'route': request.endpoint})
+
+
+@app.after_request
+def _add_request_id_header(response):
+    if 'request_id' in g:
+        response.headers['X-Request-ID'] = g.request_id
+    return response
+
+
+@app.teardown_request
+def _reset_request_log_context(exc):
+    # Соединение keep-alive обслуживается тем же greenlet'ом - контекст не должен утечь в следующий запрос
+    token = g.pop('_log_context_token', None)
+    if token is not None:
+        _log_context.reset(token)
+
+
+# --- Внешние клиенты (ленивая инициализация) ---
+class ServiceRegistry:
+    """Тяжелые SDK импортируются и создаются при первом обращении, а не при импорте app.py.
+
+    Так воркер gunicorn начинает отвечать сразу после форка. Фабрики регистрируются
+    декоратором @services.register('name'), экземпляр берется как services.name.
+    Создание идет под блокировкой, чтобы параллельные запросы не строили клиент дважды.
+    """
+
+    def __init__(self):
+        self._factories = {}
+        self._instances = {}
+        self._init_ms = {}
+        self._lock = threading.Lock()
+
+    def register(self, name):
+        def decorator(factory):
+            self._factories[name] = factory
+            return factory
+        return decorator
+
+    def get(self, name):
+        if name in self._instances:
+            return self._instances[name]
+        with self._lock:
+            if name not in self._instances:
+                started_at = time.perf_counter()
+                self._instances[name] = self._factories[name]()
+                self._init_ms[name] = round((time.perf_counter() - started_at) * 1000, 1)
+        return self._instances[name]
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name not in self._factories:
+            raise AttributeError(name)
+        return self.get(name)
+
+    def warm(self, names=None):
+        """Прогрев для хука воркера (например, post_worker_init в gunicorn)."""
+        for name in (names or list(self._factories)):
+            try:
+                self.get(name)
+            except Exception as e:
+                log.warning("Не удалось прогреть сервис", extra={'service': name, 'error': str(e)})
+
+    def stats(self):
+        return {'initialized': dict(self._init_ms), 'pending': [name for name in self._factories if name not in self._instances]}
+
+
+services = ServiceRegistry()
+
+
+@services.register('redis')
+def _create_redis_client():
+    if not REDIS_URL:
+        log.warning("REDIS_URL не найден. Отправка задач в воркер не будет работать.")
+        return None
+    import redis
+    return redis.from_url(REDIS_URL)
+
+
+@services.register('openai')
+def _create_openai_client():
+    if not OPENAI_API_KEY:
+        log.warning("OPENAI_API_KEY не найден. Улучшение промптов и Autofix не будут работать.")
+        return None
+    import openai
+    return openai.OpenAI(api_key=OPENAI_API_KEY)
+
+
+@services.register('stripe')
+def _create_stripe():
+    import stripe
+    stripe.api_key = STRIPE_SECRET_KEY
+    return stripe
+
+
+@services.register('replicate')
+def _create_replicate():
+    # Клиент replicate сам читает REPLICATE_API_TOKEN из окружения
+    import replicate
+    return replicate
+
+
+@services.register('firebase_auth')
+def _create_firebase_auth():
+    import firebase_admin
+    from firebase_admin import credentials, auth
+
+    # Сначала секретный файл на Render, затем файл в корне проекта для локальной разработки
+    cred_path = next((path for path in FIREBASE_CREDENTIAL_PATHS if os.path.exists(path)), None)
+    if cred_path:
+        cred = credentials.Certificate(cred_path)
     else:
         cred = None
-        print("!!! ВНИМАНИЕ: Не найден файл firebase_credentials.json. Аутентификация Firebase не будет работать.")
+        log.warning("Не найден файл firebase_credentials.json. Аутентификация Firebase не будет работать.")
+
+    if cred and not firebase_admin._apps:
+        firebase_admin.initialize_app(cred)
+    return auth
+
+
+@services.register('s3')
+def _create_s3_client():
+    return s3_storage.client
+
+
+# Синглтоны ниже хранят эти прокси и проверяют их через `if self._redis:` -
+# клиент создается только при первом реальном обращении.
+redis_client = LocalProxy(lambda: services.redis)
+openai_client = LocalProxy(lambda: services.openai)
+
+
+# --- Метрики (Prometheus) ---
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Metrics:
+    """Счетчики и гистограммы в памяти процесса, отдаются на /metrics в текстовом формате Prometheus.
+
+    Запись - одна короткая блокировка и пара операций со словарем, поэтому на горячем
+    пути практически бесплатна. Каждый воркер gunicorn отдает свои значения, Prometheus
+    различает их по instance. Значения, которые уже считают сами компоненты (stats()),
+    собираются коллекторами только в момент запроса /metrics.
+    """
+
+    def __init__(self, buckets):
+        self._buckets = buckets
+        self._lock = threading.Lock()
+        self._descriptions = {}
+        self._counters = defaultdict(float)
+        self._histograms = {}
+        self._collectors = []
+
+    def describe(self, name, kind, help_text):
+        self._descriptions[name] = (kind, help_text)
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] += amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        index = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * (len(self._buckets) + 1), 0.0, 0]
+            histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    @contextmanager
+    def span(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def collector(self, fn):
+        """Регистрирует функцию, которая при запросе /metrics отдает [(имя, {метки}, значение)]."""
+        self._collectors.append(fn)
+        return fn
+
+    @staticmethod
+    def _labels(labels, extra=None):
+        items = list(labels) + ([extra] if extra else [])
+        if not items:
+            return ''
+        escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in items)
+        return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(items, escaped)) + '}'
+
+    def _header(self, lines, seen, name, default_kind):
+        if name in seen:
+            return
+        seen.add(name)
+        kind, help_text = self._descriptions.get(name, (default_kind, name))
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+
+    def render(self):
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: (list(value[0]), value[1], value[2]) for key, value in self._histograms.items()}
+        lines, seen = [], set()
+        for (name, labels), value in sorted(counters.items()):
+            self._header(lines, seen, name, 'counter')
+            lines.append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), (buckets, total, count) in sorted(histograms.items()):
+            self._header(lines, seen, name, 'histogram')
+            cumulative = 0
+            for bound, bucket_count in zip(self._buckets + (float('inf'),), buckets):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f"{name}_bucket{self._labels(labels, ('le', le))} {cumulative}")
+            lines.append(f"{name}_sum{self._labels(labels)} {total}")
+            lines.append(f"{name}_count{self._labels(labels)} {count}")
+        for collect in self._collectors:
+            try:
+                samples = list(collect())
+            except Exception as e:
+                log.error("Ошибка сбора метрик", extra={'collector': collect.__name__, 'error': str(e)})
+                continue
+            for name, labels, value in samples:
+                self._header(lines, seen, name, 'gauge')
+                lines.append(f"{name}{self._labels(sorted(labels.items()))} {value}")
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics(METRICS_LATENCY_BUCKETS)
+metrics.describe('pifly_generation_stage_seconds', 'histogram', 'Duration of generation pipeline stages.')
+metrics.describe('pifly_webhook_stage_seconds', 'histogram', 'Duration of webhook handling and ingest stages.')
+metrics.describe('pifly_predictions_created_total', 'counter', 'Predictions created, by generation mode.')
+metrics.describe('pifly_predictions_finished_total', 'counter', 'Predictions that reached a final status.')
+metrics.describe('pifly_tokens_debited_total', 'counter', 'Tokens reserved for predictions, by generation mode.')
+metrics.describe('pifly_tokens_refunded_total', 'counter', 'Tokens refunded for failed predictions.')
+metrics.describe('pifly_component_stat', 'gauge', 'Internal counters reported by component stats().')
+metrics.describe('pifly_edit_queue_jobs', 'gauge', 'Autofix jobs by queue state.')
 
-if cred and not firebase_admin._apps:
-    firebase_admin.initialize_app(cred)
 
 # --- Модели Базы Данных ---
 class User(db.Model, UserMixin):
@@ -128,17 +573,312 @@ class Prediction(db.Model):
     output_url = db.Column(db.String(2048), nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     token_cost = db.Column(db.Integer, nullable=False, default=1)
+    thumbnail_url = db.Column(db.String(2048), nullable=True)
     user = db.relationship('User', backref=db.backref('predictions', lazy=True, cascade="all, delete-orphan"))
+    __table_args__ = (
+        # Архив: WHERE user_id = ? AND status = 'completed' ORDER BY created_at DESC, id DESC (keyset-пагинация).
+        # Префикс user_id обслуживает и удаление аккаунта; INCLUDE дает index-only scan для сетки архива.
+        db.Index('ix_prediction_archive', 'user_id', 'status', 'created_at', 'id',
+                 postgresql_include=['output_url', 'thumbnail_url']),
+        # Сверка со статусами Replicate: WHERE status = 'pending' ORDER BY created_at DESC.
+        # Частичный индекс остается крошечным - в нем живут только незавершенные задачи.
+        db.Index('ix_prediction_pending_created', 'created_at',
+                 postgresql_where=db.text("status = 'pending'"), sqlite_where=db.text("status = 'pending'")),
+    )
 
 class UsedTrialEmail(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(255), unique=True, nullable=False, index=True)
 
 
+class TokenLedgerEntry(db.Model):
+    """Журнал движения токенов. Возврат по задаче уникален по (prediction_id, kind)."""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.String(128), db.ForeignKey('user.id'), nullable=False, index=True)
+    prediction_id = db.Column(db.String(36), nullable=True)
+    kind = db.Column(db.String(32), nullable=False)  # debit, refund, trial_bonus, token_pack, subscription
+    amount = db.Column(db.Integer, nullable=False)  # со знаком: списание отрицательное
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    user = db.relationship('User', backref=db.backref('token_ledger', lazy=True, cascade="all, delete-orphan"))
+    __table_args__ = (db.UniqueConstraint('prediction_id', 'kind', name='uq_token_ledger_prediction_kind'),)
+
+
+# --- Кэш пользователя: проекция для load_user и опросов результата ---
+USER_PROJECTION_FIELDS = (
+    'id', 'email', 'username', 'token_balance', 'subscription_status', 'current_plan',
+    'trial_used', 'stripe_customer_id', 'stripe_subscription_id', 'subscription_ends_at',
+)
+_PENDING_USER_INVALIDATIONS = 'pifly_invalidate_user_ids'
+
+
+_USER_CACHE_SET_IF_VERSION_SCRIPT = """
+if (redis.call('GET', KEYS[2]) or '0') ~= ARGV[3] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', tonumber(ARGV[2]))
+return 1
+"""
+
+
+class UserProjectionCache:
+    """Короткоживущая проекция User (баланс, статус подписки, план) в Redis.
+
+    Источник истины - БД, любое изменение пользователя сбрасывает ключ (сразу и
+    еще раз после COMMIT) и увеличивает счетчик версии. Промах запоминает версию
+    до чтения из БД, а запись в кэш (Lua) проходит, только если версия не
+    изменилась: иначе возврат или начисление, закоммиченные между SELECT и SET,
+    дали бы старый баланс на весь TTL.
+
+    Без Redis кэш выключен и все чтения идут в БД: сброс в словаре одного процесса
+    не увидят другие воркеры gunicorn, и они до конца TTL отдавали бы старый баланс
+    и статус подписки.
+    """
+
+    def __init__(self, redis_client, ttl):
+        self._redis = redis_client
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'invalidations': 0, 'stale_writes_skipped': 0, 'errors': 0}
+
+    @property
+    def enabled(self):
+        return bool(self._redis)
+
+    @cached_property
+    def _set_if_version_script(self):
+        return self._redis.register_script(_USER_CACHE_SET_IF_VERSION_SCRIPT)
+
+    @staticmethod
+    def to_projection(user):
+        projection = {field: getattr(user, field) for field in USER_PROJECTION_FIELDS}
+        if projection['subscription_ends_at'] is not None:
+            projection['subscription_ends_at'] = projection['subscription_ends_at'].isoformat()
+        return projection
+
+    @staticmethod
+    def _from_json(raw):
+        projection = json.loads(raw)
+        if projection.get('subscription_ends_at'):
+            projection['subscription_ends_at'] = datetime.fromisoformat(projection['subscription_ends_at'])
+        return projection
+
+    def get(self, user_id):
+        """Возвращает (проекция или None, версия). Версию при промахе передают в set()."""
+        if not self.enabled:
+            return None, None
+        projection, version = None, None
+        try:
+            raw, raw_version = self._redis.mget(f"{USER_CACHE_PREFIX}{user_id}", f"{USER_CACHE_VERSION_PREFIX}{user_id}")
+            projection = self._from_json(raw) if raw is not None else None
+            version = raw_version.decode() if isinstance(raw_version, bytes) else (raw_version or '0')
+        except Exception as e:
+            self._count('errors')
+            log.warning("Ошибка чтения кэша пользователя", extra={'error': str(e), 'sampled': True})
+        self._count('hits' if projection is not None else 'misses')
+        return projection, version
+
+    def set(self, user, version):
+        """Кладет проекцию, если с момента get() пользователь не инвалидировался."""
+        if not self.enabled or version is None:
+            return
+        try:
+            stored = self._set_if_version_script(
+                keys=[f"{USER_CACHE_PREFIX}{user.id}", f"{USER_CACHE_VERSION_PREFIX}{user.id}"],
+                args=[json.dumps(self.to_projection(user)), self._ttl, version],
+            )
+            if not stored:
+                self._count('stale_writes_skipped')
+        except Exception as e:
+            self._count('errors')
+            log.warning("Ошибка записи в кэш пользователя", extra={'error': str(e), 'sampled': True})
+
+    def invalidate(self, user_id):
+        if not self.enabled:
+            return
+        self._count('invalidations')
+        try:
+            pipe = self._redis.pipeline()
+            pipe.incr(f"{USER_CACHE_VERSION_PREFIX}{user_id}")
+            pipe.expire(f"{USER_CACHE_VERSION_PREFIX}{user_id}", USER_CACHE_VERSION_TTL)
+            pipe.delete(f"{USER_CACHE_PREFIX}{user_id}")
+            pipe.execute()
+        except Exception as e:
+            self._count('errors')
+            log.warning("Ошибка сброса кэша пользователя", extra={'error': str(e), 'user_id': user_id})
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['enabled'] = int(self.enabled)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / lookups, 3) if lookups else 0.0
+        return stats
+
+
+user_projection_cache = UserProjectionCache(redis_client, USER_CACHE_TTL)
+
+
+class CachedUser(UserMixin):
+    """current_user из кэша: поля проекции читаются без SELECT.
+
+    Остальные атрибуты (связи, marketing_consent) и любая запись идут в ORM-объект,
+    который подгружается один раз по первому требованию. Если User уже есть в
+    сессии (например, после _apply_balance_delta), читаем из него - он свежее кэша.
+    """
+
+    def __init__(self, projection):
+        object.__setattr__(self, '_projection', projection)
+
+    @property
+    def is_active(self):
+        return True
+
+    def _loaded_model(self):
+        return db.session.identity_map.get(identity_key(User, self._projection['id']))
+
+    def _model(self):
+        model = self._loaded_model()
+        if model is None:
+            model = db.session.get(User, self._projection['id'])
+        if model is None:
+            raise AttributeError(f"User {self._projection['id']} no longer exists")
+        return model
+
+    def __getattr__(self, name):
+        if name.startswith('__') or name == '_projection':
+            raise AttributeError(name)
+        projection = self._projection
+        if name in projection:
+            model = self._loaded_model()
+            return getattr(model, name) if model is not None else projection[name]
+        return getattr(self._model(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._model(), name, value)
+        if name in self._projection:
+            self._projection[name] = value
+
+    def __repr__(self):
+        return f"<CachedUser {self._projection['id']}>"
+
+
+def invalidate_user_cache(user_id, session=None):
+    """Сбрасывает проекцию сейчас и повторно после COMMIT текущей транзакции."""
+    user_projection_cache.invalidate(user_id)
+    session = session if session is not None else db.session
+    session.info.setdefault(_PENDING_USER_INVALIDATIONS, set()).add(user_id)
+
+
+def cache_user_projection(user, version):
+    """Кладет пользователя в кэш, если в текущей транзакции он не менялся. version - из get() до SELECT."""
+    session = object_session(user)
+    if session is not None and (user in session.dirty or user.id in session.info.get(_PENDING_USER_INVALIDATIONS, ())):
+        return
+    user_projection_cache.set(user, version)
+
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def _invalidate_user_on_flush(mapper, connection, target):
+    # Покрывает все ORM-изменения пользователя: Stripe-обработчики, отмену подписки, удаление аккаунта
+    session = object_session(target)
+    if session is not None:
+        invalidate_user_cache(target.id, session)
+
+
+@event.listens_for(Session, 'after_commit')
+def _flush_user_invalidations(session):
+    for user_id in session.info.pop(_PENDING_USER_INVALIDATIONS, ()):
+        user_projection_cache.invalidate(user_id)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_user_invalidations(session, previous_transaction):
+    # Откаченные изменения в БД не попали, а ключ уже сброшен сразу
+    session.info.pop(_PENDING_USER_INVALIDATIONS, None)
+
+
+# --- Учет токенов: атомарные списания и возвраты ---
+
+
+def _apply_balance_delta(user_id, delta, require_balance=None):
+    """UPDATE user SET token_balance = token_balance + :delta [WHERE token_balance >= :n] RETURNING token_balance."""
+    users = User.__table__
+    statement = users.update().where(users.c.id == user_id)
+    if require_balance is not None:
+        statement = statement.where(users.c.token_balance >= require_balance)
+    statement = statement.values(token_balance=users.c.token_balance + delta).returning(users.c.token_balance)
+    new_balance = db.session.execute(statement).scalar()
+    if new_balance is None:
+        return None
+    # Если пользователь уже загружен в сессию (current_user, g.user), обновляем его без лишнего SELECT
+    loaded_user = db.session.identity_map.get(identity_key(User, user_id))
+    if loaded_user is not None:
+        set_committed_value(loaded_user, 'token_balance', new_balance)
+    invalidate_user_cache(user_id)
+    return new_balance
+
+
+def _insert_ledger_entry_once(user_id, prediction_id, kind, amount):
+    """INSERT ... ON CONFLICT DO NOTHING; возвращает False, если такая запись уже была."""
+    values = {'user_id': user_id, 'prediction_id': prediction_id, 'kind': kind, 'amount': amount, 'created_at': datetime.utcnow()}
+    if db.engine.dialect.name == 'postgresql':
+        statement = postgresql_insert(TokenLedgerEntry.__table__).values(**values).on_conflict_do_nothing()
+    else:
+        statement = sqlite_insert(TokenLedgerEntry.__table__).values(**values).on_conflict_do_nothing()
+    return db.session.execute(statement).rowcount == 1
+
+
+def reserve_tokens(user_id, amount, prediction_id):
+    """Атомарно списывает токены под задачу. Возвращает новый баланс или None, если токенов не хватает."""
+    new_balance = _apply_balance_delta(user_id, -amount, require_balance=amount)
+    if new_balance is None:
+        return None
+    db.session.add(TokenLedgerEntry(user_id=user_id, prediction_id=prediction_id, kind='debit', amount=-amount))
+    return new_balance
+
+
+def refund_tokens(user_id, amount, prediction_id):
+    """Идемпотентно возвращает токены за задачу: повторный вызов для того же prediction_id ничего не делает."""
+    if not _insert_ledger_entry_once(user_id, prediction_id, 'refund', amount):
+        log.info("Токены за задачу уже были возвращены, пропускаем", extra={'prediction_id': prediction_id})
+        return None
+    metrics.inc('pifly_tokens_refunded_total', amount)
+    return _apply_balance_delta(user_id, amount)
+
+
+def credit_tokens(user_id, amount, kind):
+    """Начисление токенов (триал, пакет токенов, подписка)."""
+    db.session.add(TokenLedgerEntry(user_id=user_id, kind=kind, amount=amount))
+    return _apply_balance_delta(user_id, amount)
+
+
+def get_token_balance(user_id):
+    projection, version = user_projection_cache.get(user_id)
+    if projection is not None:
+        return projection['token_balance']
+    user = db.session.get(User, user_id)
+    if user is None:
+        return None
+    cache_user_projection(user, version)
+    return user.token_balance
+
+
 # --- Декораторы и Загрузчик пользователя ---
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(user_id)
+    # Попадание в кэш обходится без SELECT; ORM-объект подгрузится, только если он понадобится
+    projection, version = user_projection_cache.get(user_id)
+    if projection is not None:
+        return CachedUser(projection)
+    user = db.session.get(User, user_id)
+    if user is not None:
+        cache_user_projection(user, version)
+    return user
 
 def subscription_required(f):
     @wraps(f)
@@ -151,6 +891,70 @@ def subscription_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+class VerifiedTokenCache:
+    """Кэш уже проверенных Firebase ID-токенов: sha256(токен) -> uid до истечения exp.
+
+    Плагин Figma опрашивает /api/v1/result/<id> с одним и тем же токеном,
+    поэтому проверка подписи и поиск пользователя нужны только на первом
+    запросе. Сам токен в памяти не хранится, только его хэш. Публичные
+    сертификаты Google firebase_admin и так кэширует по Cache-Control.
+    """
+
+    def __init__(self, max_entries, expiry_skew_seconds):
+        self._entries = OrderedDict()
+        self._max_entries = max_entries
+        self._expiry_skew = expiry_skew_seconds
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0}
+
+    @staticmethod
+    def _key(id_token):
+        return hashlib.sha256(id_token.encode('utf-8')).hexdigest()
+
+    def get(self, id_token):
+        key = self._key(id_token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > time.time():
+                self._entries.move_to_end(key)
+                self._stats['hits'] += 1
+                return entry[1]
+            if entry:
+                del self._entries[key]
+            self._stats['misses'] += 1
+        return None
+
+    def put(self, id_token, decoded_token):
+        expires_at = decoded_token.get('exp', 0) - self._expiry_skew
+        if expires_at <= time.time():
+            return
+        with self._lock:
+            self._entries[self._key(id_token)] = (expires_at, decoded_token['uid'])
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def evict_user(self, uid):
+        with self._lock:
+            for key in [key for key, entry in self._entries.items() if entry[1] == uid]:
+                del self._entries[key]
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, entries=len(self._entries))
+
+
+api_token_cache = VerifiedTokenCache(API_TOKEN_CACHE_MAX_ENTRIES, API_TOKEN_EXPIRY_SKEW_SECONDS)
+
+
+def _current_api_user():
+    """Пользователь API-запроса; грузится из БД только при первом обращении к g.user."""
+    if '_api_user' not in g:
+        g._api_user = User.query.get(g.user_id)
+        if not g._api_user:
+            abort(make_response(jsonify({"error": "User not found in database"}), 401))
+    return g._api_user
+
+
 def api_login_required(f):
     """Декоратор для проверки Firebase токена в API запросах."""
     @wraps(f)
@@ -160,18 +964,22 @@ def api_login_required(f):
             return jsonify({"error": "Authorization header is missing or invalid"}), 401
         
         id_token = auth_header.split('Bearer ')[1]
-        try:
-            # Проверяем токен через Firebase Admin
-            decoded_token = auth.verify_id_token(id_token)
-            uid = decoded_token['uid']
-            # Находим пользователя в нашей БД и "запоминаем" его для этого запроса
-            g.user = User.query.get(uid)
-            if not g.user:
-                 return jsonify({"error": "User not found in database"}), 401
-        except Exception as e:
-            # Если токен невалидный, возвращаем ошибку
-            return jsonify({"error": "Invalid authentication token", "details": str(e)}), 401
-        
+        uid = api_token_cache.get(id_token)
+        if uid is None:
+            try:
+                # Проверяем токен через Firebase Admin
+                decoded_token = services.firebase_auth.verify_id_token(id_token)
+                uid = decoded_token['uid']
+            except Exception as e:
+                # Если токен невалидный, возвращаем ошибку
+                return jsonify({"error": "Invalid authentication token", "details": str(e)}), 401
+            if not db.session.query(User.id).filter_by(id=uid).first():
+                return jsonify({"error": "User not found in database"}), 401
+            api_token_cache.put(id_token, decoded_token)
+
+        # "Запоминаем" пользователя для этого запроса; сама строка из БД подгрузится лениво
+        g.user_id = uid
+        g.user = LocalProxy(_current_api_user)
         return f(*args, **kwargs)
     return decorated_function
 
@@ -188,7 +996,7 @@ def session_login():
         return jsonify({"status": "error", "message": "ID token is missing."}), 400
 
     try:
-        decoded_token = auth.verify_id_token(id_token)
+        decoded_token = services.firebase_auth.verify_id_token(id_token)
         uid = decoded_token['uid']
         email = decoded_token.get('email')
         name = decoded_token.get('name', email)
@@ -222,7 +1030,7 @@ def session_login():
         return jsonify({"status": "success", "action": "redirect", "url": url_for('index')})
 
     except Exception as e:
-        print(f"Error in session_login: {e}")
+        log.warning("Ошибка входа", extra={'error': str(e)})
         return jsonify({"status": "error", "message": str(e)}), 401
 
 # --- Маршруты для юридических и вспомогательных страниц ---
@@ -238,52 +1046,597 @@ def privacy():
 def marketing_policy():
     return render_template('marketing.html')
 
+# --- Хранилище S3 (один клиент на процесс) ---
+class S3Storage:
+    """Общий для всего процесса клиент S3 с пулом соединений и счетчиками.
+
+    boto3-клиент потокобезопасен, а вот его создание - нет, поэтому клиент
+    строится один раз под блокировкой (после monkey.patch_all это gevent-lock).
+    """
+
+    def __init__(self, bucket, region, access_key_id, secret_access_key):
+        self.bucket = bucket
+        self.region = region
+        self._access_key_id = access_key_id
+        self._secret_access_key = secret_access_key
+        self._client = None
+        self._client_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._public_base_url = None
+        self._stats = {
+            'clients_created': 0,
+            'pool_hits': 0,
+            'uploads': 0,
+            'upload_errors': 0,
+            'upload_bytes': 0,
+            'upload_seconds': 0.0,
+            'dedup_index_hits': 0,
+            'dedup_head_hits': 0,
+        }
+        self._known_objects = OrderedDict()
+
+    @cached_property
+    def transfer_config(self):
+        from boto3.s3.transfer import TransferConfig
+        return TransferConfig(
+            multipart_threshold=S3_MULTIPART_THRESHOLD,
+            multipart_chunksize=S3_MULTIPART_CHUNKSIZE,
+            max_concurrency=S3_MAX_CONCURRENCY,
+        )
+
+    @property
+    def is_configured(self):
+        if self._public_base_url:
+            return True
+        return all([self._access_key_id, self._secret_access_key, self.bucket, self.region])
+
+    def use_client(self, client, public_base_url):
+        """Подключает готовый S3-совместимый клиент (локальное хранилище в BACKEND_MODE=local)."""
+        self._client = client
+        self._public_base_url = public_base_url.rstrip('/')
+        self.bucket = self.bucket or 'local'
+
+    @property
+    def client(self):
+        if self._client is not None:
+            self._incr('pool_hits')
+            return self._client
+        with self._client_lock:
+            if self._client is None:
+                import boto3
+                from botocore.config import Config as BotoConfig
+                self._client = boto3.client(
+                    's3',
+                    region_name=self.region,
+                    aws_access_key_id=self._access_key_id,
+                    aws_secret_access_key=self._secret_access_key,
+                    config=BotoConfig(
+                        max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+                        retries={'max_attempts': 3, 'mode': 'standard'},
+                        tcp_keepalive=True,
+                    ),
+                )
+                self._incr('clients_created')
+            else:
+                self._incr('pool_hits')
+        return self._client
+
+    def public_url(self, object_name):
+        if self._public_base_url:
+            return f"{self._public_base_url}/{object_name}"
+        return f"https://{self.bucket}.s3.{self.region}.amazonaws.com/{object_name}"
+
+    def upload_fileobj(self, fileobj, object_name, content_type=None):
+        """Загружает файловый объект (multipart для больших файлов) и возвращает публичный URL."""
+        if not self.is_configured:
+            raise Exception("Server configuration error for image uploads.")
+        extra_args = {'ContentType': content_type} if content_type else None
+        counter = _CountingReader(fileobj)
+        started = time.monotonic()
+        try:
+            self.client.upload_fileobj(counter, self.bucket, object_name, ExtraArgs=extra_args, Config=self.transfer_config)
+        except Exception:
+            self._incr('upload_errors')
+            raise
+        self._record_upload(counter.bytes_read, time.monotonic() - started)
+        return self.public_url(object_name)
+
+    def upload_stream(self, chunks, object_name, content_type=None):
+        """Перекачивает итератор байтовых чанков в S3, держа в памяти не больше одной части.
+
+        Если весь поток меньше одной части, делаем обычный put_object; иначе -
+        multipart upload, который при ошибке отменяется, чтобы не оставлять
+        висящих частей в бакете.
+        """
+        if not self.is_configured:
+            raise Exception("Server configuration error for image uploads.")
+        extra_args = {'ContentType': content_type} if content_type else {}
+        part_size = max(S3_MULTIPART_CHUNKSIZE, S3_MIN_PART_SIZE)
+        client = self.client
+        buffer = bytearray()
+        parts = []
+        upload_id = None
+        total_bytes = 0
+        started = time.monotonic()
+        try:
+            for chunk in chunks:
+                if not chunk:
+                    continue
+                buffer += chunk
+                total_bytes += len(chunk)
+                while len(buffer) >= part_size:
+                    if upload_id is None:
+                        upload_id = client.create_multipart_upload(Bucket=self.bucket, Key=object_name, **extra_args)['UploadId']
+                    part_number = len(parts) + 1
+                    response = client.upload_part(Bucket=self.bucket, Key=object_name, UploadId=upload_id, PartNumber=part_number, Body=bytes(memoryview(buffer)[:part_size]))
+                    parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+                    del buffer[:part_size]
+
+            if upload_id is None:
+                client.put_object(Bucket=self.bucket, Key=object_name, Body=bytes(buffer), **extra_args)
+            else:
+                if buffer:
+                    part_number = len(parts) + 1
+                    response = client.upload_part(Bucket=self.bucket, Key=object_name, UploadId=upload_id, PartNumber=part_number, Body=bytes(buffer))
+                    parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+                client.complete_multipart_upload(Bucket=self.bucket, Key=object_name, UploadId=upload_id, MultipartUpload={'Parts': parts})
+        except Exception:
+            self._incr('upload_errors')
+            if upload_id is not None:
+                try:
+                    client.abort_multipart_upload(Bucket=self.bucket, Key=object_name, UploadId=upload_id)
+                except Exception as abort_error:
+                    log.error("Не удалось отменить multipart upload", extra={'object_name': object_name, 'error': str(abort_error)})
+            raise
+        self._record_upload(total_bytes, time.monotonic() - started)
+        return self.public_url(object_name)
+
+    def object_exists(self, object_name):
+        """Проверка для дедупликации: сначала локальный индекс известных ключей, затем HEAD в S3."""
+        with self._stats_lock:
+            if object_name in self._known_objects:
+                self._known_objects.move_to_end(object_name)
+                self._stats['dedup_index_hits'] += 1
+                return True
+        if not self.is_configured:
+            raise Exception("Server configuration error for image uploads.")
+        from botocore.exceptions import ClientError
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=object_name)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+        self._incr('dedup_head_hits')
+        self.remember_object(object_name)
+        return True
+
+    def remember_object(self, object_name):
+        with self._stats_lock:
+            self._known_objects[object_name] = True
+            self._known_objects.move_to_end(object_name)
+            while len(self._known_objects) > S3_KNOWN_OBJECTS_INDEX_SIZE:
+                self._known_objects.popitem(last=False)
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        seconds = stats['upload_seconds']
+        stats['upload_bytes_per_second'] = round(stats['upload_bytes'] / seconds, 1) if seconds else 0.0
+        return stats
+
+    def _incr(self, key, amount=1):
+        with self._stats_lock:
+            self._stats[key] += amount
+
+    def _record_upload(self, num_bytes, seconds):
+        with self._stats_lock:
+            self._stats['uploads'] += 1
+            self._stats['upload_bytes'] += num_bytes
+            self._stats['upload_seconds'] += seconds
+
+
+class _CountingReader:
+    """Обертка над потоком, считающая прочитанные байты для метрик загрузки."""
+
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        chunk = self._fileobj.read(size)
+        self.bytes_read += len(chunk)
+        return chunk
+
+    def __getattr__(self, name):
+        return getattr(self._fileobj, name)
+
+
+s3_storage = S3Storage(AWS_S3_BUCKET_NAME, AWS_S3_REGION, AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY)
+
 # --- Функции-помощники для Stripe и S3 ---
-def upload_file_to_s3(file_to_upload):
-    if not all([AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, AWS_S3_BUCKET_NAME, AWS_S3_REGION]):
-        raise Exception("Server configuration error for image uploads.")
-    s3_client = boto3.client('s3', region_name=AWS_S3_REGION, aws_access_key_id=AWS_ACCESS_KEY_ID, aws_secret_access_key=AWS_SECRET_ACCESS_KEY)
+def upload_file_to_s3(file_to_upload, content_hash=None):
+    """Загружает файл в S3 под ключом uploads/<sha256><ext>: одинаковые байты хранятся один раз."""
     _, f_ext = os.path.splitext(file_to_upload.filename)
-    object_name = f"uploads/{uuid.uuid4()}{f_ext}"
-    file_to_upload.stream.seek(0)
-    s3_client.upload_fileobj(file_to_upload.stream, AWS_S3_BUCKET_NAME, object_name, ExtraArgs={'ContentType': file_to_upload.content_type})
-    hosted_image_url = f"https://{AWS_S3_BUCKET_NAME}.s3.{AWS_S3_REGION}.amazonaws.com/{object_name}"
-    print(f"!!! Изображение загружено на Amazon S3: {hosted_image_url}")
-    return hosted_image_url
-
-def resize_image_for_openai(file_storage):
-    """Сжимает изображение, если оно слишком большое для OpenAI Vision."""
-    MAX_SIZE_MB = 20
-    MAX_DIMENSION = 2048 
+    if not content_hash:
+        content_hash = sha256_of_stream(file_to_upload.stream)
+    object_name = f"uploads/{content_hash}{f_ext.lower()}"
+
+    def upload():
+        if s3_storage.object_exists(object_name):
+            return s3_storage.public_url(object_name)
+        file_to_upload.stream.seek(0)
+        hosted_image_url = s3_storage.upload_fileobj(file_to_upload.stream, object_name, file_to_upload.content_type)
+        s3_storage.remember_object(object_name)
+        log.debug("Изображение загружено в S3", extra={'url': hosted_image_url, 'sampled': True})
+        return hosted_image_url
+
+    # Этапы upload и prompt_rewrite (и параллельные запросы с той же картинкой) грузят один ключ одновременно:
+    # проверка существования промахивается у обоих, поэтому PUT делает только первый, остальные ждут его URL
+    return s3_upload_single_flight.do(object_name, upload)
+
+def sha256_of_stream(stream, chunk_size=1024 * 1024):
+    stream.seek(0)
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(chunk_size), b''):
+        digest.update(chunk)
+    stream.seek(0)
+    return digest.hexdigest()
+
+# --- Пул для CPU-работы с изображениями ---
+class ImageWorkPool:
+    """Выносит декодирование/ресайз/кодирование PIL из gevent-цикла в настоящие потоки ОС.
+
+    После monkey.patch_all обычные потоки - это greenlet'ы, и CPU-работа PIL
+    блокирует весь воркер. gevent.threadpool.ThreadPool использует нативные
+    потоки, а PIL отпускает GIL на декодировании, ресайзе и кодировании.
+    Очередь ограничена: если ждущих задач больше IMAGE_POOL_MAX_PENDING,
+    запрос быстро получает 503 вместо того, чтобы копить память.
+
+    Слот освобождается, когда закончил нативный поток, а не ждавший его greenlet:
+    если greenlet убили (отмена соседнего этапа), работа в потоке все равно идет
+    до конца и продолжает занимать место в пуле.
+    """
+
+    def __init__(self, size, max_pending, acquire_timeout):
+        self._pool = ThreadPool(size)
+        self._slots = threading.BoundedSemaphore(size + max_pending)
+        self._acquire_timeout = acquire_timeout
+        self._lock = threading.Lock()
+        self._stats = {'submitted': 0, 'rejected': 0, 'in_flight': 0, 'max_in_flight': 0, 'total_seconds': 0.0}
+
+    def run(self, fn, *args):
+        if not self._slots.acquire(timeout=self._acquire_timeout):
+            with self._lock:
+                self._stats['rejected'] += 1
+            raise PipelineError('Server is busy processing images. Please try again.', 503)
+        started = time.monotonic()
+        with self._lock:
+            self._stats['submitted'] += 1
+            self._stats['in_flight'] += 1
+            self._stats['max_in_flight'] = max(self._stats['max_in_flight'], self._stats['in_flight'])
+
+        def finished(_result):
+            with self._lock:
+                self._stats['in_flight'] -= 1
+                self._stats['total_seconds'] += time.monotonic() - started
+            self._slots.release()
 
-    img = Image.open(file_storage.stream)
-    
-    file_storage.stream.seek(0, os.SEEK_END)
-    file_size_mb = file_storage.stream.tell() / (1024 * 1024)
-    file_storage.stream.seek(0)
+        try:
+            async_result = self._pool.spawn(fn, *args)
+        except BaseException:
+            finished(None)
+            raise
+        async_result.rawlink(finished)
+        return async_result.get()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        completed = stats['submitted'] - stats['in_flight']
+        stats['queue_depth'] = max(0, stats['in_flight'] - self._pool.maxsize)
+        stats['avg_latency_ms'] = round(stats['total_seconds'] / completed * 1000, 1) if completed else 0.0
+        return stats
+
+
+image_pool = ImageWorkPool(IMAGE_POOL_SIZE, IMAGE_POOL_MAX_PENDING, IMAGE_POOL_ACQUIRE_TIMEOUT)
+
+
+def _probe_image_header(data):
+    with Image.open(io.BytesIO(data)) as img:
+        return img.size, img.format
+
+
+def _resize_image_bytes(data, max_dimension):
+    img = Image.open(io.BytesIO(data))
+    img.thumbnail((max_dimension, max_dimension))
 
-    if file_size_mb < MAX_SIZE_MB and max(img.size) <= MAX_DIMENSION:
-        return file_storage
-    
-    img.thumbnail((MAX_DIMENSION, MAX_DIMENSION))
-    
     byte_arr = io.BytesIO()
     img_format = img.format if img.format in ['JPEG', 'PNG'] else 'JPEG'
-    
+
     if img_format == 'JPEG':
+        if img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
         img.save(byte_arr, format=img_format, quality=85)
     else:
         img.save(byte_arr, format=img_format)
+    return byte_arr.getvalue(), img_format
 
-    byte_arr.seek(0)
-    
-    compressed_file = FileStorage(
-        stream=byte_arr,
-        filename=file_storage.filename,
+
+OPENAI_MAX_SIZE_MB = 20
+OPENAI_MAX_DIMENSION = 2048
+
+
+class PreparedImage:
+    """Загруженная картинка, прочитанная один раз и разделяемая всеми этапами запроса.
+
+    Байты хранятся в одном bytes-объекте: io.BytesIO(bytes) не копирует буфер,
+    пока в него не пишут, а хэш и base64 считаются по memoryview. Размер и
+    формат берутся из заголовка (Image.open ленивый и не декодирует пиксели),
+    а уменьшенная копия для OpenAI строится только если она действительно нужна.
+    """
+
+    def __init__(self, data, filename, content_type):
+        self.data = data
+        self.buffer = memoryview(data)
+        self.filename = filename
+        self.content_type = content_type
+
+    @classmethod
+    def from_file_storage(cls, file_storage):
+        return cls(file_storage.read(), file_storage.filename, file_storage.content_type)
+
+    @cached_property
+    def sha256(self):
+        return hashlib.sha256(self.buffer).hexdigest()
+
+    @cached_property
+    def _header(self):
+        return image_pool.run(_probe_image_header, self.data)
+
+    @property
+    def size(self):
+        return self._header[0]
+
+    @property
+    def format(self):
+        return self._header[1]
+
+    @property
+    def size_mb(self):
+        return self.buffer.nbytes / (1024 * 1024)
+
+    def file_storage(self):
+        return FileStorage(stream=io.BytesIO(self.data), filename=self.filename, content_type=self.content_type)
+
+    def data_url(self):
+        return f"data:{self.content_type};base64,{base64.b64encode(self.buffer).decode('ascii')}"
+
+    @property
+    def needs_openai_resize(self):
+        return self.size_mb >= OPENAI_MAX_SIZE_MB or max(self.size) > OPENAI_MAX_DIMENSION
+
+
+def resize_image_for_openai(prepared_image):
+    """Сжимает изображение, если оно слишком большое для OpenAI Vision."""
+    if not prepared_image.needs_openai_resize:
+        return prepared_image.file_storage()
+
+    resized_data, img_format = image_pool.run(_resize_image_bytes, prepared_image.data, OPENAI_MAX_DIMENSION)
+    return FileStorage(
+        stream=io.BytesIO(resized_data),
+        filename=prepared_image.filename,
         content_type=f'image/{img_format.lower()}'
     )
-    
-    return compressed_file
+
+# --- Общие примитивы конкурентности ---
+class RateLimiter:
+    """Простой token bucket: не больше rate запросов в секунду с запасом burst."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class SingleFlight:
+    """Склеивает одновременные вызовы с одинаковым ключом в один: остальные ждут его результат."""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {'done': threading.Event(), 'result': None, 'error': None}
+        if not leader:
+            call['done'].wait()
+            if call['error']:
+                raise call['error']
+            return call['result']
+        try:
+            call['result'] = fn()
+            return call['result']
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call['done'].set()
+
+
+s3_upload_single_flight = SingleFlight()
+
+
+# --- Промпты и вызовы GPT-4o ---
+AUTOFIX_GENERATION_SYSTEM_PROMPT = (
+    "You are an expert prompt engineer for an image editing AI. A user will provide a request, possibly in any language, to modify an existing uploaded image. "
+    "Your tasks are: 1. Understand the user's core intent for image modification. 2. Translate the request to concise and clear English if it's not already. "
+    "3. Rephrase any unput text it into a concise, command-based instruction in English, don't try to analyze the image or try to understand the needs. After the command, you MUST append the exact phrase: ', do not change anything else, keep the original style'. Example: 'Add a frog on the leaf, do not change anything else, keep the original style' "
+    "The output should be only the refined prompt in English language, no explanations or conversational fluff."
+)
+
+AUTOFIX_INTENT_SYSTEM_PROMPT = (
+    "You are a classification AI. Analyze the user's original request. Your task is to generate a JSON object with two keys: "
+    "1. \"intent\": Classify the user's intent as one of three possible string values: 'ADD', 'REMOVE', or 'REPLACE'. "
+    "2. \"mask_prompt\": Extract a very short (1-5 words) name in english language for the object being acted upon. Example: 't-shirt' not a 'woman's t-shirt'. Be specific with the object. You can use an object's position. Example: 'person on the right'."
+    "You MUST only output the raw JSON object."
+)
+
+BASIC_EDIT_SYSTEM_PROMPT = (
+    "You are an expert  engineer for an image editing AI. A user will provide a request, possibly in any language, to modify an existing uploaded image. "
+    "Your tasks are: 1. Understand the user's core intent for image modification. 2. Translate the request to concise and clear English if it's not already. "
+    "3. Rephrase any unput text it into a concise, command-based instruction in English, don't try to analyze the image or try to understand the needs. After the command, you MUST append the exact phrase: ', do not change anything else, keep the original style'. Example: 'Add a frog on the leaf, do not change anything else, keep the original style' "
+    "The output should be only the refined prompt in English language, no explanations or conversational fluff."
+)
+
+def rewrite_edit_prompt(prompt, image_url):
+    messages = [{"role": "system", "content": BASIC_EDIT_SYSTEM_PROMPT}, {"role": "user", "content": [{"type": "text", "text": prompt}, {"type": "image_url", "image_url": {"url": image_url}}]}]
+    response = openai_client.chat.completions.create(model="gpt-4o", messages=messages, max_tokens=150)
+    return response.choices[0].message.content.strip().replace('\\n', ' ').replace('\\r', ' ').strip()
+
+def generate_autofix_prompt(prompt, image_data_url):
+    messages_for_generation = [{"role": "system", "content": AUTOFIX_GENERATION_SYSTEM_PROMPT}, {"role": "user", "content": [{"type": "text", "text": prompt}, {"type": "image_url", "image_url": {"url": image_data_url}}]}]
+    generation_response = openai_client.chat.completions.create(model="gpt-4o", messages=messages_for_generation, max_tokens=250, temperature=0.2)
+    return generation_response.choices[0].message.content.strip()
+
+def classify_edit_intent(prompt):
+    messages_for_intent = [{"role": "system", "content": AUTOFIX_INTENT_SYSTEM_PROMPT}, {"role": "user", "content": prompt}]
+    intent_response = openai_client.chat.completions.create(model="gpt-4o", messages=messages_for_intent, max_tokens=100, response_format={"type": "json_object"}, temperature=0.0)
+    return json.loads(intent_response.choices[0].message.content)
+
+# --- Кэш переписанных промптов ---
+class PromptCache:
+    """Кэш ответов GPT-4o по ключу (режим, версия системного промпта, промпт, хэш картинки).
+
+    Перед Redis стоит небольшой LRU в памяти процесса. Версия системного
+    промпта - это хэш его текста плюс PROMPT_CACHE_VERSION, так что правка
+    промпта автоматически инвалидирует старые записи.
+    """
+
+    def __init__(self, redis_client, max_local_entries, ttl):
+        self._redis = redis_client
+        self._max_local_entries = max_local_entries
+        self._ttl = ttl
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+        self._single_flight = SingleFlight()
+        self._stats = {'local_hits': 0, 'redis_hits': 0, 'misses': 0}
+
+    @staticmethod
+    def make_key(mode, system_prompt, prompt, image_hash=''):
+        system_version = hashlib.sha256(f"{PROMPT_CACHE_VERSION}:{system_prompt}".encode('utf-8')).hexdigest()[:16]
+        digest = hashlib.sha256('\x1f'.join([mode, system_version, prompt, image_hash or '']).encode('utf-8')).hexdigest()
+        return f"{PROMPT_CACHE_PREFIX}{mode}:{digest}"
+
+    def get_or_compute(self, mode, system_prompt, prompt, image_hash, compute):
+        key = self.make_key(mode, system_prompt, prompt, image_hash)
+        cached = self._get(key)
+        if cached is not None:
+            return cached
+        return self._single_flight.do(key, lambda: self._compute_and_store(key, compute))
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['local_entries'] = len(self._local)
+        lookups = stats['local_hits'] + stats['redis_hits'] + stats['misses']
+        stats['hit_rate'] = round((stats['local_hits'] + stats['redis_hits']) / lookups, 3) if lookups else 0.0
+        return stats
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._local.get(key)
+            if entry and entry[0] > time.monotonic():
+                self._local.move_to_end(key)
+                self._stats['local_hits'] += 1
+                return entry[1]
+        if self._redis:
+            try:
+                raw = self._redis.get(key)
+            except Exception as e:
+                log.warning("Ошибка чтения кэша промптов", extra={'error': str(e), 'sampled': True})
+                raw = None
+            if raw is not None:
+                value = json.loads(raw)
+                self._put_local(key, value)
+                with self._lock:
+                    self._stats['redis_hits'] += 1
+                return value
+        with self._lock:
+            self._stats['misses'] += 1
+        return None
+
+    def _compute_and_store(self, key, compute):
+        value = compute()
+        self._put_local(key, value)
+        if self._redis:
+            try:
+                self._redis.set(key, json.dumps(value), ex=self._ttl)
+            except Exception as e:
+                log.warning("Ошибка записи в кэш промптов", extra={'error': str(e), 'sampled': True})
+        return value
+
+    def _put_local(self, key, value):
+        with self._lock:
+            self._local[key] = (time.monotonic() + self._ttl, value)
+            self._local.move_to_end(key)
+            while len(self._local) > self._max_local_entries:
+                self._local.popitem(last=False)
+
+
+prompt_cache = PromptCache(redis_client, PROMPT_CACHE_LOCAL_ENTRIES, PROMPT_CACHE_TTL)
+
+# --- Параллельное выполнение независимых этапов ---
+class StageTimeout(Exception):
+    pass
+
+def run_stages_concurrently(stages, timeout=STAGE_TIMEOUT_SECONDS):
+    """Запускает независимые этапы в отдельных greenlet'ах и ждет все.
+
+    stages - словарь {имя: функция без аргументов}. Возвращает (результаты,
+    тайминги в мс). Если какой-то этап упал или не уложился в timeout,
+    остальные отменяются, а исключение пробрасывается дальше.
+    """
+    def timed(fn):
+        started = time.monotonic()
+        result = fn()
+        return result, (time.monotonic() - started) * 1000
+
+    # Каждому этапу - своя копия контекста запроса, чтобы логи этапов несли request_id
+    greenlets = {name: gevent.spawn(contextvars.copy_context().run, timed, fn) for name, fn in stages.items()}
+    try:
+        gevent.joinall(list(greenlets.values()), timeout=timeout, raise_error=True)
+        unfinished = [name for name, greenlet in greenlets.items() if not greenlet.ready()]
+        if unfinished:
+            raise StageTimeout(f"Stages timed out after {timeout}s: {', '.join(unfinished)}")
+    except BaseException:
+        gevent.killall([greenlet for greenlet in greenlets.values() if not greenlet.ready()], block=False)
+        raise
+    results = {name: greenlet.value[0] for name, greenlet in greenlets.items()}
+    timings = {name: round(greenlet.value[1], 1) for name, greenlet in greenlets.items()}
+    return results, timings
+
+def server_timing_header(timings):
+    return ', '.join(f"{name};dur={duration}" for name, duration in timings.items())
 
 # В файле app.py
 
@@ -297,7 +1650,7 @@ def handle_checkout_session(session_data):
             user = User.query.filter_by(stripe_customer_id=customer_id).first()
         
         if not user:
-            print(f"Webhook Error: Could not find user for checkout session {session_data.get('id')}")
+            log.error("Stripe: не найден пользователь для checkout session", extra={'checkout_session_id': session_data.get('id')})
             return
 
         if not user.stripe_customer_id and customer_id:
@@ -305,7 +1658,7 @@ def handle_checkout_session(session_data):
         
         if session_data.get('subscription'):
             subscription_id = session_data.get('subscription')
-            subscription = stripe.Subscription.retrieve(subscription_id)
+            subscription = services.stripe.Subscription.retrieve(subscription_id)
             user.stripe_subscription_id = subscription_id
             
             # --- ИСПРАВЛЕННАЯ ЛОГИКА СТАТУСОВ ---
@@ -316,8 +1669,8 @@ def handle_checkout_session(session_data):
                 user.subscription_ends_at = datetime.fromtimestamp(subscription.trial_end, tz=timezone.utc)
                 if not user.trial_used:
                     user.trial_used = True
-                    user.token_balance += 1500
-                    print(f"User {user.id} started a free trial. Added 1500 tokens.")
+                    credit_tokens(user.id, 1500, 'trial_bonus')
+                    log.info("Пользователь начал триал, начислено 1500 токенов", extra={'user_id': user.id})
             elif stripe_status == 'active':
                 user.subscription_status = 'active'
                 user.subscription_ends_at = datetime.fromtimestamp(subscription.current_period_end, tz=timezone.utc)
@@ -330,15 +1683,16 @@ def handle_checkout_session(session_data):
                 handle_successful_payment(subscription=subscription)
 
         elif session_data.get('payment_intent'):
-            user.token_balance += 1000
+            credit_tokens(user.id, 1000, 'token_pack')
 
+        invalidate_user_cache(user.id)
         db.session.commit()
 
 def handle_subscription_change(subscription):
     with app.app_context():
         user = User.query.filter_by(stripe_subscription_id=subscription.id).first()
         if not user: 
-            print(f"Webhook: Could not find user for subscription change: {subscription.id}")
+            log.warning("Stripe: не найден пользователь для изменения подписки", extra={'subscription_id': subscription.id})
             return
 
         # ИСПРАВЛЕНИЕ: Сначала проверяем, существует ли поле, перед тем как его использовать
@@ -359,6 +1713,7 @@ def handle_subscription_change(subscription):
             if user.subscription_status == 'canceled':
                 user.current_plan = 'free' # Если подписка окончательно отменена
 
+        invalidate_user_cache(user.id)
         db.session.commit()
 
 def handle_successful_payment(invoice=None, subscription=None):
@@ -370,7 +1725,7 @@ def handle_successful_payment(invoice=None, subscription=None):
         if not user: return
         
         if not subscription:
-            subscription = stripe.Subscription.retrieve(subscription_id)
+            subscription = services.stripe.Subscription.retrieve(subscription_id)
         
         price_id = subscription.items.data[0].price.id
         token_map = {'taste': 1500, 'best': 4500, 'pro': 15000}
@@ -378,8 +1733,9 @@ def handle_successful_payment(invoice=None, subscription=None):
         
         # Начисляем токены только если это не триал (чтобы не дублировать)
         if plan_name in token_map and not subscription.trial_end:
-            user.token_balance += token_map[plan_name]
+            credit_tokens(user.id, token_map[plan_name], 'subscription')
         
+        invalidate_user_cache(user.id)
         db.session.commit()
 
 # --- Маршруты для биллинга и Stripe Webhook ---
@@ -399,8 +1755,54 @@ def billing():
 @login_required
 @subscription_required
 def archive():
-    predictions = Prediction.query.filter_by(user_id=current_user.id, status='completed').order_by(Prediction.created_at.desc()).all()
-    return render_template('archive.html', predictions=predictions)
+    predictions, next_cursor = archive_page(current_user.id, None)
+    return render_template('archive.html', predictions=predictions, next_cursor=next_cursor)
+
+@app.route('/archive/items')
+@login_required
+@subscription_required
+def archive_items():
+    """Следующая страница архива для бесконечной прокрутки."""
+    try:
+        predictions, next_cursor = archive_page(current_user.id, request.args.get('cursor'))
+    except ValueError:
+        return jsonify({'error': 'Invalid cursor'}), 400
+    return jsonify({
+        'items': [{
+            'id': prediction.id,
+            'output_url': prediction.output_url,
+            'thumbnail_url': prediction.thumbnail_url or prediction.output_url,
+            'created_at': prediction.created_at.strftime('%Y-%m-%d %H:%M'),
+        } for prediction in predictions],
+        'next_cursor': next_cursor,
+    })
+
+def archive_page(user_id, cursor):
+    """Keyset-пагинация по (created_at, id) в порядке убывания: без OFFSET и без подсчета строк."""
+    query = Prediction.query.filter_by(user_id=user_id, status='completed')
+    if cursor:
+        created_at, prediction_id = decode_archive_cursor(cursor)
+        query = query.filter(db.or_(
+            Prediction.created_at < created_at,
+            db.and_(Prediction.created_at == created_at, Prediction.id < prediction_id),
+        ))
+    predictions = query.order_by(Prediction.created_at.desc(), Prediction.id.desc()).limit(ARCHIVE_PAGE_SIZE + 1).all()
+    next_cursor = None
+    if len(predictions) > ARCHIVE_PAGE_SIZE:
+        predictions = predictions[:ARCHIVE_PAGE_SIZE]
+        next_cursor = encode_archive_cursor(predictions[-1])
+    return predictions, next_cursor
+
+def encode_archive_cursor(prediction):
+    raw = f"{prediction.created_at.isoformat()}|{prediction.id}"
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+def decode_archive_cursor(cursor):
+    try:
+        created_at, prediction_id = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8').split('|', 1)
+        return datetime.fromisoformat(created_at), prediction_id
+    except Exception as e:
+        raise ValueError(f"Invalid archive cursor: {cursor}") from e
 
 @app.route('/create-checkout-session', methods=['POST'])
 @login_required
@@ -430,7 +1832,7 @@ def create_checkout_session():
             checkout_params['customer_email'] = current_user.email
             checkout_params['metadata'] = {'user_id': current_user.id}
 
-        checkout_session = stripe.checkout.Session.create(**checkout_params)
+        checkout_session = services.stripe.checkout.Session.create(**checkout_params)
         return redirect(checkout_session.url, code=303)
     except Exception as e:
         flash(f'Stripe error: {str(e)}', 'error')
@@ -442,7 +1844,7 @@ def create_portal_session():
     if not current_user.stripe_customer_id:
         flash('Stripe customer not found.', 'error')
         return redirect(url_for('billing'))
-    portal_session = stripe.billing_portal.Session.create(
+    portal_session = services.stripe.billing_portal.Session.create(
         customer=current_user.stripe_customer_id,
         return_url=url_for('billing', _external=True),
     )
@@ -456,7 +1858,7 @@ def cancel_subscription():
         return redirect(url_for('billing'))
     try:
         # Отправляем команду в Stripe
-        stripe.Subscription.modify(
+        services.stripe.Subscription.modify(
             current_user.stripe_subscription_id,
             cancel_at_period_end=True
         )
@@ -481,9 +1883,9 @@ def delete_account():
 
         if stripe_subscription_id:
             try:
-                stripe.Subscription.cancel(stripe_subscription_id)
-            except stripe.error.InvalidRequestError as e:
-                print(f"Subscription {stripe_subscription_id} might already be canceled or invalid: {e}")
+                services.stripe.Subscription.cancel(stripe_subscription_id)
+            except services.stripe.error.InvalidRequestError as e:
+                log.warning("Подписка уже отменена или недействительна", extra={'subscription_id': stripe_subscription_id, 'error': str(e)})
 
         # Удаляем связанные генерации (cascade должен сработать, но для надежности)
         Prediction.query.filter_by(user_id=user_id).delete()
@@ -496,7 +1898,8 @@ def delete_account():
         db.session.delete(user_to_delete)
         
         # Удаляем пользователя из Firebase
-        auth.delete_user(user_id)
+        services.firebase_auth.delete_user(user_id)
+        api_token_cache.evict_user(user_id)
         
         db.session.commit()
         
@@ -512,8 +1915,8 @@ def stripe_webhook():
     payload = request.get_data(as_text=True)
     sig_header = request.headers.get('Stripe-Signature')
     try:
-        event = stripe.Webhook.construct_event(payload, sig_header, STRIPE_WEBHOOK_SECRET)
-    except (ValueError, stripe.error.SignatureVerificationError) as e:
+        event = services.stripe.Webhook.construct_event(payload, sig_header, STRIPE_WEBHOOK_SECRET)
+    except (ValueError, services.stripe.error.SignatureVerificationError) as e:
         return 'Invalid payload or signature', 400
     
     event_map = {
@@ -538,26 +1941,26 @@ def get_result(prediction_id):
     if prediction.status == 'completed':
         return jsonify({'status': 'completed', 'output_url': prediction.output_url, 'new_token_balance': current_user.token_balance})
     if prediction.status == 'failed':
-        return jsonify({'status': 'failed', 'error': 'Generation failed. Your tokens have been refunded.', 'new_token_balance': User.query.get(current_user.id).token_balance})
+        return jsonify({'status': 'failed', 'error': 'Generation failed. Your tokens have been refunded.', 'new_token_balance': current_user.token_balance})
     if prediction.status == 'pending' and prediction.replicate_id:
-        try:
-            headers = {"Authorization": f"Bearer {REPLICATE_API_TOKEN}", "Content-Type": "application/json"}
-            poll_url = f"https://api.replicate.com/v1/predictions/{prediction.replicate_id}"
-            get_response = requests.get(poll_url, headers=headers)
-            get_response.raise_for_status()
-            status_data = get_response.json()
-            if status_data.get("status") == "failed":
-                print(f"!!! Polling detected failed prediction {prediction.id}. Refunding tokens.")
-                prediction.status = 'failed'
-                user = User.query.get(prediction.user_id)
-                if user:
-                    user.token_balance += prediction.token_cost
-                db.session.commit()
-                return jsonify({'status': 'failed', 'error': f"Generation failed: {status_data.get('error', 'Unknown error')}. Your tokens have been refunded.", 'new_token_balance': user.token_balance if user else None})
-        except requests.exceptions.RequestException as e:
-            print(f"!!! Error polling Replicate status for {prediction.id}: {e}")
+        failed_response = _settle_failed_from_cache(prediction)
+        if failed_response:
+            return jsonify(failed_response)
     return jsonify({'status': 'pending'})
 
+def _settle_failed_from_cache(prediction):
+    """Если фоновый опрос уже видит задачу упавшей - сразу фиксируем это и возвращаем ответ для клиента."""
+    status_data = replicate_status_poller.cached_status(prediction.replicate_id)
+    if not status_data or status_data.get('status') not in ('failed', 'canceled'):
+        return None
+    log.info("Опрос обнаружил проваленную задачу, возвращаем токены", extra={'prediction_id': prediction.id})
+    replicate_status_poller.settle(status_data)
+    db.session.refresh(prediction)
+    if prediction.status != 'failed':
+        return None
+    token_balance = get_token_balance(prediction.user_id)
+    return {'status': 'failed', 'error': f"Generation failed: {status_data.get('error') or 'Unknown error'}. Your tokens have been refunded.", 'new_token_balance': token_balance}
+
 # В app.py
 
 # ... здесь заканчивается ваша функция get_result() ...
@@ -567,450 +1970,844 @@ def get_result(prediction_id):
 @app.route('/api/v1/result/<string:prediction_id>', methods=['GET'])
 @api_login_required # Снова используем наш охранник
 def api_get_result(prediction_id):
-    # Пользователя получаем из g
-    user = g.user
+    # Для проверки владельца достаточно uid из токена - пользователя из БД не грузим
     prediction = Prediction.query.get(prediction_id)
     
-    if not prediction or prediction.user_id != user.id:
+    if not prediction or prediction.user_id != g.user_id:
         return jsonify({'error': 'Prediction not found or access denied'}), 404
         
-    if prediction.status == 'completed':
-        return jsonify({
-            'status': 'completed', 
-            'output_url': prediction.output_url, 
-            'new_token_balance': user.token_balance
-        })
-
-    if prediction.status == 'failed':
-        # Перезапрашиваем пользователя, чтобы получить баланс ПОСЛЕ возврата токенов, который мог произойти в вебхуке
-        updated_user = User.query.get(user.id)
-        return jsonify({
-            'status': 'failed', 
-            'error': 'Generation failed. Your tokens have been refunded.', 
-            'new_token_balance': updated_user.token_balance
-        })
-
-    # Если статус 'pending', пробуем опросить Replicate, чтобы ускорить процесс, если вебхук задерживается
+    if prediction.status in ('completed', 'failed'):
+        # Берем баланс ПОСЛЕ возможного возврата токенов в вебхуке
+        token_balance = get_token_balance(g.user_id)
+        payload = _result_payload(prediction, token_balance)
+        payload.pop('prediction_id')
+        return jsonify(payload)
+
+    # Если статус 'pending', смотрим, что уже знает фоновый опрос Replicate (сами в Replicate не ходим)
     if prediction.status == 'pending' and prediction.replicate_id:
-        try:
-            headers = {"Authorization": f"Bearer {REPLICATE_API_TOKEN}", "Content-Type": "application/json"}
-            poll_url = f"https://api.replicate.com/v1/predictions/{prediction.replicate_id}"
-            get_response = requests.get(poll_url, headers=headers)
-            get_response.raise_for_status()
-            status_data = get_response.json()
-
-            # Если Replicate говорит, что задача провалилась
-            if status_data.get("status") == "failed":
-                print(f"!!! API polling detected failed prediction {prediction.id}. Refunding tokens.")
-                prediction.status = 'failed'
-                # Возвращаем токены пользователю
-                user.token_balance += prediction.token_cost
-                db.session.commit()
-                return jsonify({
-                    'status': 'failed', 
-                    'error': f"Generation failed: {status_data.get('error', 'Unknown error')}. Your tokens have been refunded.", 
-                    'new_token_balance': user.token_balance
-                })
-        except requests.exceptions.RequestException as e:
-            # Не страшно, если опрос не удался, основной механизм - вебхук
-            print(f"!!! API polling error for {prediction.id}: {e}")
+        failed_response = _settle_failed_from_cache(prediction)
+        if failed_response:
+            return jsonify(failed_response)
     
     # Если ничего из вышеперечисленного не сработало, значит задача все еще в работе
     return jsonify({'status': 'pending'})
 
+# --- Конвейер генерации (общий для /process-image и /api/v1/process) ---
+# Этапы: validate -> decode -> upload + prompt-rewrite (параллельно) -> reserve tokens -> dispatch.
+FLUX_KONTEXT_MODEL_VERSION = "black-forest-labs/flux-kontext-max:0b9c317b23e79a9a0d8b9602ff4d04030d433055927fb7c4b91c44234a6818c4"
+UPSCALE_MODEL_VERSION = "dfad41707589d68ecdccd1dfa600d55a208f9310748e44bfe35b4a6291453d5e"
+
+# Сюда можно добавить функции hook(stage_name, duration_ms), например для метрик
+def _observe_generation_stage(ctx, stage, duration_ms):
+    metrics.observe('pifly_generation_stage_seconds', duration_ms / 1000, mode=ctx.mode_key or 'unknown', stage=stage)
+
+
+# Хуки вызываются как hook(ctx, stage, duration_ms) после каждого этапа конвейера
+PIPELINE_STAGE_HOOKS = [_observe_generation_stage]
+
+
+class PipelineError(Exception):
+    """Ошибка, которую нужно показать клиенту как есть, с указанным HTTP-статусом."""
+
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+
+class GenerationContext:
+    """Состояние одного запроса на генерацию, которое этапы конвейера заполняют по очереди."""
+
+    def __init__(self, user, form, image_file, mode_key=None):
+        self.user = user
+        self.form = form
+        self.image_file = image_file
+        self.mode_key = mode_key
+        self.prompt = form.get('prompt', '')
+        self.token_cost = None
+        self.image = None
+        self.results = {}
+        self.prediction = None
+        self.new_token_balance = None
+        self.timings = {}
+
+    def record_timing(self, stage, duration_ms):
+        self.timings[stage] = round(duration_ms, 1)
+        for hook in PIPELINE_STAGE_HOOKS:
+            hook(self, stage, duration_ms)
+
+    def run_stage(self, stage, fn):
+        started = time.monotonic()
+        try:
+            return fn()
+        finally:
+            self.record_timing(stage, (time.monotonic() - started) * 1000)
+
+
+
+class GenerationMode:
+    """Базовый режим генерации. Наследники переопределяют нужные этапы."""
+
+    name = None
+    key = None  # короткое имя для метрик
+
+    def validate(self, ctx):
+        pass
+
+    def decode(self, ctx):
+        ctx.image = PreparedImage.from_file_storage(ctx.image_file)
+
+    def concurrent_stages(self, ctx):
+        """Независимые друг от друга этапы (загрузки, запросы к GPT-4o): {имя: функция}."""
+        return {}
+
+    def dispatch(self, ctx):
+        raise NotImplementedError
+
+    def require_tokens(self, ctx, token_cost):
+        """Ранний отказ до дорогих этапов. Решает все равно атомарный reserve_tokens.
+
+        Баланс из кэша может отставать (например, сразу после покупки), поэтому
+        отказываем, только если и свежее значение из БД меньше цены.
+        """
+        ctx.token_cost = token_cost
+        if ctx.user.token_balance >= token_cost:
+            return
+        fresh_balance = db.session.query(User.token_balance).filter_by(id=ctx.user.id).scalar()
+        if fresh_balance is None or fresh_balance < token_cost:
+            raise PipelineError(f'Insufficient tokens. Need {token_cost}.', 403)
+
+    def submit_to_replicate(self, ctx, model_version_id, replicate_input):
+        prediction_replicate = services.replicate.predictions.create(
+            version=model_version_id,
+            input=replicate_input,
+            webhook=url_for('replicate_webhook', _external=True),
+            webhook_events_filter=["completed"]
+        )
+        ctx.prediction.replicate_id = prediction_replicate.id
+        db.session.commit()
+
+
+class BasicEditMode(GenerationMode):
+    name = "Basic (старый 'Edit')"
+    key = 'edit'
+
+    def validate(self, ctx):
+        self.require_tokens(ctx, 65)
+        if not openai_client:
+            raise PipelineError("Server configuration error: OpenAI client not configured.", 500)
+
+    def concurrent_stages(self, ctx):
+        def rewrite_prompt():
+            # Сжатая копия для OpenAI нужна только при промахе кэша
+            image_for_openai = resize_image_for_openai(ctx.image)
+            content_hash = None if ctx.image.needs_openai_resize else ctx.image.sha256
+            s3_url_for_openai = upload_file_to_s3(image_for_openai, content_hash=content_hash)
+            log.debug("Сжатое изображение для OpenAI загружено", extra={'url': s3_url_for_openai, 'sampled': True})
+            return rewrite_edit_prompt(ctx.prompt, s3_url_for_openai)
+
+        return {
+            'upload': lambda: upload_file_to_s3(ctx.image.file_storage(), content_hash=ctx.image.sha256),
+            'prompt_rewrite': lambda: prompt_cache.get_or_compute('edit', BASIC_EDIT_SYSTEM_PROMPT, ctx.prompt, ctx.image.sha256, rewrite_prompt),
+        }
+
+    def dispatch(self, ctx):
+        replicate_input = {
+            "input_image": ctx.results['upload'],
+            "prompt": ctx.results['prompt_rewrite'],
+            "output_format": "png"
+        }
+        self.submit_to_replicate(ctx, FLUX_KONTEXT_MODEL_VERSION, replicate_input)
+
+
+class AutofixMode(GenerationMode):
+    name = "PRO (через Autofix/воркер)"
+    key = 'autofix'
+
+    def validate(self, ctx):
+        self.require_tokens(ctx, 100)
+        if not redis_client:
+            raise PipelineError('Server configuration error: Redis is not available.', 500)
+        if not openai_client:
+            raise PipelineError("Server configuration error: OpenAI client not configured.", 500)
+        if not ctx.prompt:
+            raise PipelineError('A text description is required for PRO mode.', 400)
+
+    def decode(self, ctx):
+        super().decode(ctx)
+        ctx.results['original_width'], ctx.results['original_height'] = ctx.image.size
+
+    def concurrent_stages(self, ctx):
+        # ИСПОЛЬЗУЕМ base64, а не s3-ссылку: GPT-4o получает картинку прямо в запросе
+        def generation_prompt():
+            return generate_autofix_prompt(ctx.prompt, ctx.image.data_url())
+
+        return {
+            'upload': lambda: upload_file_to_s3(ctx.image.file_storage(), content_hash=ctx.image.sha256),
+            'generation_prompt': lambda: prompt_cache.get_or_compute('autofix_generation', AUTOFIX_GENERATION_SYSTEM_PROMPT, ctx.prompt, ctx.image.sha256, generation_prompt),
+            'intent': lambda: prompt_cache.get_or_compute('autofix_intent', AUTOFIX_INTENT_SYSTEM_PROMPT, ctx.prompt, '', lambda: classify_edit_intent(ctx.prompt)),
+        }
+
+    def dispatch(self, ctx):
+        generation_prompt = ctx.results['generation_prompt']
+        intent_data = ctx.results['intent']
+        job_data = {
+            "prediction_id": ctx.prediction.id,
+            "app_base_url": APP_BASE_URL,
+            "original_s3_url": ctx.results['upload'],
+            "intent": intent_data.get("intent"), "generation_prompt": generation_prompt,
+            "mask_prompt": intent_data.get("mask_prompt") or generation_prompt,
+            "token_cost": ctx.token_cost, "user_id": ctx.user.id,
+            "original_width": ctx.results['original_width'], "original_height": ctx.results['original_height']
+        }
+        edit_job_queue.enqueue(job_data, lane=ctx.user.current_plan)
+
+
+class UpscaleMode(GenerationMode):
+    name = "Upscale"
+    key = 'upscale'
+
+    def validate(self, ctx):
+        # Получаем все значения с ползунков, включая Fractality (num_inference_steps)
+        scale_factor = float(ctx.form.get('scale_factor', '2'))
+        ctx.results['upscale_input'] = {
+            "scale_factor": scale_factor,
+            "creativity": round(float(ctx.form.get('creativity', '35')) / 100.0, 4),
+            "resemblance": round(float(ctx.form.get('resemblance', '60')) / 100.0 * 3.0, 4),
+            "dynamic": round(float(ctx.form.get('dynamic', '6')), 4),
+            "num_inference_steps": int(ctx.form.get('fractality', '18')),
+            "output_format": "png"
+        }
+        if scale_factor <= 2: token_cost = 17
+        elif scale_factor <= 4: token_cost = 65
+        else: token_cost = 150
+        self.require_tokens(ctx, token_cost)
+
+    def concurrent_stages(self, ctx):
+        return {'upload': lambda: upload_file_to_s3(ctx.image.file_storage(), content_hash=ctx.image.sha256)}
+
+    def dispatch(self, ctx):
+        replicate_input = dict(ctx.results['upscale_input'], image=ctx.results['upload'])
+        self.submit_to_replicate(ctx, UPSCALE_MODEL_VERSION, replicate_input)
+
+
+GENERATION_MODES = {
+    ('edit', 'autofix'): AutofixMode(),
+    ('edit', None): BasicEditMode(),
+    ('upscale', None): UpscaleMode(),
+}
+
+
+def resolve_generation_mode(form):
+    mode = form.get('mode')
+    edit_mode = form.get('edit_mode') if mode == 'edit' else None
+    generation_mode = GENERATION_MODES.get((mode, edit_mode)) or GENERATION_MODES.get((mode, None))
+    if not generation_mode:
+        raise PipelineError('Invalid mode specified', 400)
+    return generation_mode
+
+
+def run_generation_pipeline(user, form, files, source='web'):
+    """Проводит запрос на генерацию через все этапы и возвращает заполненный GenerationContext."""
+    if 'image' not in files:
+        raise PipelineError('Image is missing', 400)
+    generation_mode = resolve_generation_mode(form)
+    bind_log_context(mode=generation_mode.key, source=source)
+    ctx = GenerationContext(user, form, files['image'], mode_key=generation_mode.key)
+
+    ctx.run_stage('validate', lambda: generation_mode.validate(ctx))
+    ctx.run_stage('decode', lambda: generation_mode.decode(ctx))
+
+    stages = generation_mode.concurrent_stages(ctx)
+    if stages:
+        results, timings = run_stages_concurrently(stages)
+        ctx.results.update(results)
+        for stage, duration_ms in timings.items():
+            ctx.record_timing(stage, duration_ms)
+
+    def reserve():
+        ctx.prediction = Prediction(user_id=user.id, token_cost=ctx.token_cost, status='pending')
+        db.session.add(ctx.prediction)
+        db.session.flush()
+        ctx.new_token_balance = reserve_tokens(user.id, ctx.token_cost, ctx.prediction.id)
+        if ctx.new_token_balance is None:
+            # Баланс мог уйти параллельным запросом между проверкой и списанием
+            raise PipelineError(f'Insufficient tokens. Need {ctx.token_cost}.', 403)
+        db.session.commit()
+        bind_log_context(prediction_id=ctx.prediction.id)
+        metrics.inc('pifly_predictions_created_total', mode=ctx.mode_key)
+        metrics.inc('pifly_tokens_debited_total', ctx.token_cost, mode=ctx.mode_key)
+    ctx.run_stage('reserve_tokens', reserve)
+    ctx.run_stage('dispatch', lambda: generation_mode.dispatch(ctx))
+    log.info("Задача на генерацию принята", extra={'timings_ms': ctx.timings, 'token_cost': ctx.token_cost, 'sampled': True})
+    return ctx
+
+
+def generation_response(ctx, status_code):
+    response = jsonify({'prediction_id': ctx.prediction.id, 'new_token_balance': ctx.new_token_balance})
+    response.status_code = status_code
+    response.headers['Server-Timing'] = server_timing_header(ctx.timings)
+    return response
+
+
 @app.route('/process-image', methods=['POST'])
 @login_required
 @subscription_required
 def process_image():
-    if 'image' not in request.files:
-        return jsonify({'error': 'Image is missing'}), 400
-    
-    mode = request.form.get('mode')
-    
     try:
-        if mode == 'edit':
-            edit_mode = request.form.get('edit_mode')
-            
-            if edit_mode == 'autofix':
-                # --- ИСПРАВЛЕННАЯ ЛОГИКА ДЛЯ PRO-РЕЖИМА ('autofix') ---
-                print("!!! РЕЖИМ: PRO (через Autofix/воркер)")
-                token_cost = 100
-                if current_user.token_balance < token_cost:
-                    return jsonify({'error': f'Insufficient tokens. Need {token_cost}.'}), 403
-                if not redis_client:
-                    raise Exception("Redis is not configured on the server.")
-
-                prompt = request.form.get('prompt', '')
-                if not prompt:
-                    return jsonify({'error': 'A text description is required for PRO mode.'}), 400
-
-                uploaded_file = request.files['image']
-                image_data = uploaded_file.read()
-
-                img_for_size_check = Image.open(io.BytesIO(image_data))
-                original_width, original_height = img_for_size_check.size
-
-                original_for_upload = FileStorage(stream=io.BytesIO(image_data), filename=uploaded_file.filename, content_type=uploaded_file.content_type)
-                original_s3_url = upload_file_to_s3(original_for_upload)
-                
-                # ИСПОЛЬЗУЕМ base64, а не s3_url_for_openai, которого здесь нет
-                base64_image = base64.b64encode(image_data).decode('utf-8')
-                image_data_url = f"data:{uploaded_file.content_type};base64,{base64_image}"
-                
-                generation_system_prompt = (
-                    "You are an expert prompt engineer for an image editing AI. A user will provide a request, possibly in any language, to modify an existing uploaded image. "
-                    "Your tasks are: 1. Understand the user's core intent for image modification. 2. Translate the request to concise and clear English if it's not already. "
-                    "3. Rephrase any unput text it into a concise, command-based instruction in English, don't try to analyze the image or try to understand the needs. After the command, you MUST append the exact phrase: ', do not change anything else, keep the original style'. Example: 'Add a frog on the leaf, do not change anything else, keep the original style' "
-                    "The output should be only the refined prompt in English language, no explanations or conversational fluff."
-                )
-                
-                messages_for_generation = [{"role": "system", "content": generation_system_prompt}, {"role": "user", "content": [{"type": "text", "text": prompt}, {"type": "image_url", "image_url": {"url": image_data_url}}]}]
-                generation_response = openai_client.chat.completions.create(model="gpt-4o", messages=messages_for_generation, max_tokens=250, temperature=0.2)
-                generation_prompt = generation_response.choices[0].message.content.strip()
-
-                intent_system_prompt = (
-                    "You are a classification AI. Analyze the user's original request. Your task is to generate a JSON object with two keys: "
-                    "1. \"intent\": Classify the user's intent as one of three possible string values: 'ADD', 'REMOVE', or 'REPLACE'. "
-                    "2. \"mask_prompt\": Extract a very short (1-5 words) name in english language for the object being acted upon. Example: 't-shirt' not a 'woman's t-shirt'. Be specific with the object. You can use an object's position. Example: 'person on the right'."
-                    "You MUST only output the raw JSON object."
-                )
-                messages_for_intent = [{"role": "system", "content": intent_system_prompt}, {"role": "user", "content": prompt}]
-                intent_response = openai_client.chat.completions.create(model="gpt-4o", messages=messages_for_intent, max_tokens=100, response_format={"type": "json_object"}, temperature=0.0)
-                intent_data = json.loads(intent_response.choices[0].message.content)
-                intent = intent_data.get("intent")
-                mask_prompt = intent_data.get("mask_prompt")
-                if not mask_prompt: mask_prompt = generation_prompt
-                
-                current_user.token_balance -= token_cost
-                new_prediction = Prediction(user_id=current_user.id, token_cost=token_cost, status='pending')
-                db.session.add(new_prediction)
-                db.session.commit()
-
-                job_data = {
-                    "prediction_id": new_prediction.id,
-                    "app_base_url": APP_BASE_URL,
-                    "original_s3_url": original_s3_url,
-                    "intent": intent, "generation_prompt": generation_prompt,
-                    "mask_prompt": mask_prompt, "token_cost": token_cost, "user_id": current_user.id,
-                    "original_width": original_width, "original_height": original_height
-                }
-                redis_client.lpush('pifly_edit_jobs', json.dumps(job_data))
-                return jsonify({'prediction_id': new_prediction.id, 'new_token_balance': current_user.token_balance})
-
-            else:
-                # --- Логика для режима "Basic" (старый "Edit") ---
-                # Эта часть кода остается без изменений, она работает правильно.
-                print("!!! РЕЖИМ: Basic (старый 'Edit')")
-                token_cost = 65
-                if current_user.token_balance < token_cost:
-                    return jsonify({'error': f'Insufficient tokens. Need {token_cost}.'}), 403
-            
-                uploaded_file = request.files['image']
-                prompt = request.form.get('prompt', '')
-                if not openai_client: raise Exception("OpenAI client not configured.")
-            
-                image_data = uploaded_file.read()
-            
-                file_for_resize = FileStorage(stream=io.BytesIO(image_data), filename=uploaded_file.filename, content_type=uploaded_file.content_type)
-                image_for_openai = resize_image_for_openai(file_for_resize)
-                s3_url_for_openai = upload_file_to_s3(image_for_openai)
-                print(f"!!! Сжатое изображение для OpenAI загружено: {s3_url_for_openai}")
-            
-                file_for_replicate = FileStorage(stream=io.BytesIO(image_data), filename=uploaded_file.filename, content_type=uploaded_file.content_type)
-                s3_url_for_replicate = upload_file_to_s3(file_for_replicate)
-                print(f"!!! Оригинальное изображение для Replicate загружено: {s3_url_for_replicate}")
-            
-                edit_system_prompt = (
-                "You are an expert  engineer for an image editing AI. A user will provide a request, possibly in any language, to modify an existing uploaded image. "
-                "Your tasks are: 1. Understand the user's core intent for image modification. 2. Translate the request to concise and clear English if it's not already. "
-                "3. Rephrase any unput text it into a concise, command-based instruction in English, don't try to analyze the image or try to understand the needs. After the command, you MUST append the exact phrase: ', do not change anything else, keep the original style'. Example: 'Add a frog on the leaf, do not change anything else, keep the original style' "
-                "The output should be only the refined prompt in English language, no explanations or conversational fluff."
-                )
-                messages = [{"role": "system", "content": edit_system_prompt}, {"role": "user", "content": [{"type": "text", "text": prompt}, {"type": "image_url", "image_url": {"url": s3_url_for_openai}}]}]
-                response = openai_client.chat.completions.create(model="gpt-4o", messages=messages, max_tokens=150)
-                final_prompt = response.choices[0].message.content.strip().replace('\\n', ' ').replace('\\r', ' ').strip()
-            
-                replicate_input = {
-                    "input_image": s3_url_for_replicate,
-                    "prompt": final_prompt,
-                    "output_format": "png"
-                }
-                model_version_id = "black-forest-labs/flux-kontext-max:0b9c317b23e79a9a0d8b9602ff4d04030d433055927fb7c4b91c44234a6818c4"
-            
-                current_user.token_balance -= token_cost
-                new_prediction_db = Prediction(user_id=current_user.id, token_cost=token_cost)
-                db.session.add(new_prediction_db)
-                db.session.commit()
-            
-                prediction_replicate = replicate.predictions.create(
-                    version=model_version_id,
-                    input=replicate_input,
-                    webhook=url_for('replicate_webhook', _external=True),
-                    webhook_events_filter=["completed"]
-                )
-            
-                new_prediction_db.replicate_id = prediction_replicate.id
-                db.session.commit()
-            
-                return jsonify({'prediction_id': new_prediction_db.id, 'new_token_balance': current_user.token_balance})
-
-        elif mode == 'upscale':
-            # --- НОВАЯ ЛОГИКА для "Upscale" через библиотеку REPLICATE ---
-            print("!!! РЕЖИМ: Upscale")
-        
-            # Получаем все значения с ползунков, включая новый Fractality
-            scale_factor = float(request.form.get('scale_factor', '2'))
-            creativity = round(float(request.form.get('creativity', '35')) / 100.0, 4)
-            resemblance = round(float(request.form.get('resemblance', '60')) / 100.0 * 3.0, 4)
-            dynamic = round(float(request.form.get('dynamic', '6')) , 4)
-            fractality = int(request.form.get('fractality', '18')) # num_inference_steps
-        
-            # Рассчитываем стоимость
-            if scale_factor <= 2: token_cost = 17
-            elif scale_factor <= 4: token_cost = 65
-            else: token_cost = 150
-        
-            if current_user.token_balance < token_cost:
-                return jsonify({'error': f'Insufficient tokens. Need {token_cost}.'}), 403
-        
-            s3_url = upload_file_to_s3(request.files['image'])
-        
-            # Формируем input согласно вашей новой схеме
-            replicate_input = {
-                "image": s3_url,
-                "scale_factor": scale_factor,
-                "creativity": creativity,
-                "resemblance": resemblance,
-                "dynamic": dynamic,
-                "num_inference_steps": fractality,
-                "output_format": "png"
-            }
-        
-            # ВАЖНО: Убедитесь, что этот ID соответствует модели из вашей схемы
-            model_version_id = "dfad41707589d68ecdccd1dfa600d55a208f9310748e44bfe35b4a6291453d5e"
-        
-            current_user.token_balance -= token_cost
-            new_prediction = Prediction(user_id=current_user.id, token_cost=token_cost)
-            db.session.add(new_prediction)
-            db.session.commit()
-        
-            # Вызов через библиотеку replicate
-            prediction_replicate = replicate.predictions.create(
-                version=model_version_id,
-                input=replicate_input,
-                webhook=url_for('replicate_webhook', _external=True),
-                webhook_events_filter=["completed"]
-            )
-        
-            new_prediction.replicate_id = prediction_replicate.id
-            db.session.commit()
-        
-            return jsonify({'prediction_id': new_prediction.id, 'new_token_balance': current_user.token_balance})
-
+        ctx = run_generation_pipeline(current_user, request.form, request.files)
+        return generation_response(ctx, 200)
+    except PipelineError as e:
+        db.session.rollback()
+        return jsonify({'error': e.message}), e.status_code
+    except HTTPException:
+        # abort() из глубины пайплайна (например, 401 из _current_api_user) отдаем как есть
+        db.session.rollback()
+        raise
     except Exception as e:
         db.session.rollback()
-        import traceback
-        traceback.print_exc()
+        log.exception("Ошибка обработки запроса на генерацию")
         return jsonify({'error': f'An internal server error occurred. Please try again. Error: {str(e)}'}), 500
 
 
-# В app.py
-
-# ... здесь заканчивается ваша функция process_image() ...
-
-
-# --- ВСТАВЬТЕ ЭТОТ НОВЫЙ МАРШРУТ ---
 @app.route('/api/v1/process', methods=['POST'])
 @api_login_required # Используем наш новый декоратор-охранник
 def api_process():
-    # Пользователя получаем из g, который установил декоратор
-    user = g.user
+    try:
+        # Пользователя получаем из g, который установил декоратор
+        ctx = run_generation_pipeline(g.user, request.form, request.files, source='api')
+        return generation_response(ctx, 202)
+    except PipelineError as e:
+        db.session.rollback()
+        return jsonify({'error': e.message}), e.status_code
+    except HTTPException:
+        # abort() из глубины пайплайна (например, 401 из _current_api_user) отдаем как есть
+        db.session.rollback()
+        raise
+    except Exception as e:
+        db.session.rollback()
+        log.exception("Ошибка обработки запроса на генерацию")
+        return jsonify({'error': f'An internal server error occurred: {str(e)}'}), 500
 
-    if 'image' not in request.files:
-        return jsonify({'error': 'Image is missing'}), 400
 
-    mode = request.form.get('mode')
-    
-    try:
-        # --- Логика для режима "Edit" ---
-        if mode == 'edit':
-            edit_mode = request.form.get('edit_mode')
-            
-            # --- Логика для PRO-режима ('autofix') ---
-            if edit_mode == 'autofix':
-                print("!!! API РЕЖИМ: PRO (через Autofix/воркер)")
-                token_cost = 100
-                if user.token_balance < token_cost:
-                    return jsonify({'error': f'Insufficient tokens. Need {token_cost}.'}), 403
-                if not redis_client:
-                    return jsonify({'error': 'Server configuration error: Redis is not available.'}), 500
-
-                prompt = request.form.get('prompt', '')
-                if not prompt:
-                    return jsonify({'error': 'A text description is required for PRO mode.'}), 400
-
-                uploaded_file = request.files['image']
-                image_data = uploaded_file.read()
-
-                img_for_size_check = Image.open(io.BytesIO(image_data))
-                original_width, original_height = img_for_size_check.size
-
-                original_for_upload = FileStorage(stream=io.BytesIO(image_data), filename=uploaded_file.filename, content_type=uploaded_file.content_type)
-                original_s3_url = upload_file_to_s3(original_for_upload)
-                
-                base64_image = base64.b64encode(image_data).decode('utf-8')
-                image_data_url = f"data:{uploaded_file.content_type};base64,{base64_image}"
-                
-                generation_system_prompt = (
-                    "You are an expert prompt engineer for an image editing AI. A user will provide a request, possibly in any language, to modify an existing uploaded image. "
-                    "Your tasks are: 1. Understand the user's core intent for image modification. 2. Translate the request to concise and clear English if it's not already. "
-                    "3. Rephrase any unput text it into a concise, command-based instruction in English, don't try to analyze the image or try to understand the needs. After the command, you MUST append the exact phrase: ', do not change anything else, keep the original style'. Example: 'Add a frog on the leaf, do not change anything else, keep the original style' "
-                    "The output should be only the refined prompt in English language, no explanations or conversational fluff."
-                )
-                
-                messages_for_generation = [{"role": "system", "content": generation_system_prompt}, {"role": "user", "content": [{"type": "text", "text": prompt}, {"type": "image_url", "image_url": {"url": image_data_url}}]}]
-                generation_response = openai_client.chat.completions.create(model="gpt-4o", messages=messages_for_generation, max_tokens=250, temperature=0.2)
-                generation_prompt = generation_response.choices[0].message.content.strip()
-
-                intent_system_prompt = (
-                    "You are a classification AI. Analyze the user's original request. Your task is to generate a JSON object with two keys: "
-                    "1. \"intent\": Classify the user's intent as one of three possible string values: 'ADD', 'REMOVE', or 'REPLACE'. "
-                    "2. \"mask_prompt\": Extract a very short (1-5 words) name in english language for the object being acted upon. Example: 't-shirt' not a 'woman's t-shirt'. Be specific with the object. You can use an object's position. Example: 'person on the right'."
-                    "You MUST only output the raw JSON object."
-                )
-                messages_for_intent = [{"role": "system", "content": intent_system_prompt}, {"role": "user", "content": prompt}]
-                intent_response = openai_client.chat.completions.create(model="gpt-4o", messages=messages_for_intent, max_tokens=100, response_format={"type": "json_object"}, temperature=0.0)
-                intent_data = json.loads(intent_response.choices[0].message.content)
-                intent = intent_data.get("intent")
-                mask_prompt = intent_data.get("mask_prompt")
-                if not mask_prompt: mask_prompt = generation_prompt
-                
-                user.token_balance -= token_cost
-                new_prediction = Prediction(user_id=user.id, token_cost=token_cost, status='pending')
-                db.session.add(new_prediction)
-                db.session.commit()
-
-                job_data = {
-                    "prediction_id": new_prediction.id, "app_base_url": APP_BASE_URL,
-                    "original_s3_url": original_s3_url, "intent": intent, 
-                    "generation_prompt": generation_prompt, "mask_prompt": mask_prompt, 
-                    "token_cost": token_cost, "user_id": user.id,
-                    "original_width": original_width, "original_height": original_height
-                }
-                redis_client.lpush('pifly_edit_jobs', json.dumps(job_data))
-                return jsonify({'prediction_id': new_prediction.id, 'new_token_balance': user.token_balance}), 202
-
-            # --- Логика для Basic-режима ('edit') ---
+# --- Push-уведомления о готовых результатах (SSE) ---
+class ResultNotifier:
+    """Рассылает уведомления "результат готов" открытым SSE-подключениям.
+
+    С Redis каждый процесс держит одно pub/sub-подключение (psubscribe на
+    pifly_results:*) и раздает события локальным подписчикам, так что число
+    подключений к Redis не растет с числом ждущих пользователей. Без Redis
+    публикация сразу раздается подписчикам этого процесса.
+    """
+
+    def __init__(self, redis_client):
+        self._redis = redis_client
+        self._subscribers = {}
+        self._lock = threading.Lock()
+        self._listener_started = False
+
+    def publish(self, user_id, prediction_id, status):
+        # Публикация происходит ровно при переходе задачи в конечный статус
+        metrics.inc('pifly_predictions_finished_total', status=status)
+        message = {'user_id': user_id, 'prediction_id': prediction_id, 'status': status}
+        try:
+            if self._redis:
+                self._redis.publish(f"{RESULT_CHANNEL_PREFIX}{user_id}", json.dumps(message))
             else:
-                print("!!! API РЕЖИМ: Basic (старый 'Edit')")
-                token_cost = 65
-                if user.token_balance < token_cost:
-                    return jsonify({'error': f'Insufficient tokens. Need {token_cost}.'}), 403
-            
-                uploaded_file = request.files['image']
-                prompt = request.form.get('prompt', '')
-                if not openai_client: return jsonify({'error': "Server configuration error: OpenAI client not configured."}), 500
-            
-                image_data = uploaded_file.read()
-            
-                file_for_resize = FileStorage(stream=io.BytesIO(image_data), filename=uploaded_file.filename, content_type=uploaded_file.content_type)
-                image_for_openai = resize_image_for_openai(file_for_resize)
-                s3_url_for_openai = upload_file_to_s3(image_for_openai)
-            
-                file_for_replicate = FileStorage(stream=io.BytesIO(image_data), filename=uploaded_file.filename, content_type=uploaded_file.content_type)
-                s3_url_for_replicate = upload_file_to_s3(file_for_replicate)
-            
-                edit_system_prompt = (
-                "You are an expert  engineer for an image editing AI. A user will provide a request, possibly in any language, to modify an existing uploaded image. "
-                "Your tasks are: 1. Understand the user's core intent for image modification. 2. Translate the request to concise and clear English if it's not already. "
-                "3. Rephrase any unput text it into a concise, command-based instruction in English, don't try to analyze the image or try to understand the needs. After the command, you MUST append the exact phrase: ', do not change anything else, keep the original style'. Example: 'Add a frog on the leaf, do not change anything else, keep the original style' "
-                "The output should be only the refined prompt in English language, no explanations or conversational fluff."
-                )
-                messages = [{"role": "system", "content": edit_system_prompt}, {"role": "user", "content": [{"type": "text", "text": prompt}, {"type": "image_url", "image_url": {"url": s3_url_for_openai}}]}]
-                response = openai_client.chat.completions.create(model="gpt-4o", messages=messages, max_tokens=150)
-                final_prompt = response.choices[0].message.content.strip().replace('\\n', ' ').replace('\\r', ' ').strip()
-            
-                replicate_input = {
-                    "input_image": s3_url_for_replicate,
-                    "prompt": final_prompt,
-                    "output_format": "png"
-                }
-                model_version_id = "black-forest-labs/flux-kontext-max:0b9c317b23e79a9a0d8b9602ff4d04030d433055927fb7c4b91c44234a6818c4"
-            
-                user.token_balance -= token_cost
-                new_prediction_db = Prediction(user_id=user.id, token_cost=token_cost)
-                db.session.add(new_prediction_db)
-                db.session.commit()
-            
-                prediction_replicate = replicate.predictions.create(
-                    version=model_version_id,
-                    input=replicate_input,
-                    webhook=url_for('replicate_webhook', _external=True),
-                    webhook_events_filter=["completed"]
-                )
-            
-                new_prediction_db.replicate_id = prediction_replicate.id
-                db.session.commit()
-            
-                return jsonify({'prediction_id': new_prediction_db.id, 'new_token_balance': user.token_balance}), 202
+                self._dispatch(message)
+        except Exception as e:
+            # Уведомление - только ускорение, клиент все равно может опросить /get-result
+            log.error("Не удалось опубликовать результат", extra={'prediction_id': prediction_id, 'error': str(e)})
+
+    def subscribe(self, user_id):
+        self._ensure_listener()
+        subscription = queue.Queue()
+        with self._lock:
+            self._subscribers.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, user_id, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(user_id)
+            if subscribers:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[user_id]
+
+    def _dispatch(self, message):
+        with self._lock:
+            subscribers = list(self._subscribers.get(message.get('user_id'), ()))
+        for subscription in subscribers:
+            subscription.put(message)
+
+    def _ensure_listener(self):
+        if not self._redis or self._listener_started:
+            return
+        with self._lock:
+            if self._listener_started:
+                return
+            threading.Thread(target=self._listen, name='result-notifier', daemon=True).start()
+            self._listener_started = True
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.psubscribe(f"{RESULT_CHANNEL_PREFIX}*")
+                for item in pubsub.listen():
+                    if item.get('type') == 'pmessage':
+                        self._dispatch(json.loads(item['data']))
+            except Exception as e:
+                log.warning("Подписка на уведомления о результатах оборвалась", extra={'error': str(e)})
+                time.sleep(1)
 
-        # --- Логика для режима "Upscale" ---
-        elif mode == 'upscale':
-            print("!!! API РЕЖИМ: Upscale")
-        
-            scale_factor = float(request.form.get('scale_factor', '2'))
-            creativity = round(float(request.form.get('creativity', '35')) / 100.0, 4)
-            resemblance = round(float(request.form.get('resemblance', '60')) / 100.0 * 3.0, 4)
-            dynamic = round(float(request.form.get('dynamic', '6')) , 4)
-            fractality = int(request.form.get('fractality', '18'))
-        
-            if scale_factor <= 2: token_cost = 17
-            elif scale_factor <= 4: token_cost = 65
-            else: token_cost = 150
-        
-            if user.token_balance < token_cost:
-                return jsonify({'error': f'Insufficient tokens. Need {token_cost}.'}), 403
-        
-            s3_url = upload_file_to_s3(request.files['image'])
-        
-            replicate_input = {
-                "image": s3_url,
-                "scale_factor": scale_factor,
-                "creativity": creativity,
-                "resemblance": resemblance,
-                "dynamic": dynamic,
-                "num_inference_steps": fractality,
-                "output_format": "png"
-            }
-        
-            model_version_id = "dfad41707589d68ecdccd1dfa600d55a208f9310748e44bfe35b4a6291453d5e"
-        
-            user.token_balance -= token_cost
-            new_prediction = Prediction(user_id=user.id, token_cost=token_cost)
-            db.session.add(new_prediction)
+
+result_notifier = ResultNotifier(redis_client)
+
+
+def _result_payload(prediction, token_balance):
+    if prediction.status == 'completed':
+        return {'prediction_id': prediction.id, 'status': 'completed', 'output_url': prediction.output_url, 'new_token_balance': token_balance}
+    return {'prediction_id': prediction.id, 'status': 'failed', 'error': 'Generation failed. Your tokens have been refunded.', 'new_token_balance': token_balance}
+
+
+def _finished_results(user_id, prediction_ids):
+    predictions = Prediction.query.filter(
+        Prediction.id.in_(prediction_ids),
+        Prediction.user_id == user_id,
+        Prediction.status.in_(['completed', 'failed']),
+    ).all()
+    if not predictions:
+        return []
+    token_balance = get_token_balance(user_id)
+    return [_result_payload(prediction, token_balance) for prediction in predictions]
+
+
+@app.route('/results/stream', methods=['GET'])
+@login_required
+def results_stream():
+    """SSE-поток результатов для ?ids=<prediction_id>,... вместо опроса /get-result каждые 3 секунды."""
+    prediction_ids = [pid for pid in request.args.get('ids', '').split(',') if pid][:RESULT_STREAM_MAX_IDS]
+    if not prediction_ids:
+        return jsonify({'error': 'No prediction ids specified'}), 400
+    user_id = current_user.id
+    # Фоновая сверка подстрахует, если вебхук от Replicate так и не придет
+    replicate_status_poller.ensure_started()
+
+    def format_event(payload):
+        return f"event: result\ndata: {json.dumps(payload)}\n\n"
+
+    def generate():
+        # Подписываемся до первой проверки БД, чтобы не пропустить результат между ними
+        subscription = result_notifier.subscribe(user_id)
+        try:
+            pending = set(prediction_ids)
+            for payload in _finished_results(user_id, list(pending)):
+                pending.discard(payload['prediction_id'])
+                yield format_event(payload)
+            # Пока ждем, соединение с БД не держим
+            db.session.remove()
+
+            deadline = time.monotonic() + RESULT_STREAM_MAX_SECONDS
+            while pending and time.monotonic() < deadline:
+                try:
+                    message = subscription.get(timeout=RESULT_STREAM_HEARTBEAT_SECONDS)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                if message.get('prediction_id') not in pending:
+                    continue
+                for payload in _finished_results(user_id, [message['prediction_id']]):
+                    pending.discard(payload['prediction_id'])
+                    yield format_event(payload)
+                db.session.remove()
+        finally:
+            result_notifier.unsubscribe(user_id, subscription)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+# --- Дедупликация повторных вебхуков ---
+class ProcessedWebhookEvent(db.Model):
+    """Уже обработанные вебхуки (используется, когда нет Redis)."""
+    key = db.Column(db.String(255), primary_key=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
+
+
+class WebhookDeduplicator:
+    """Отсекает повторные доставки вебхуков за O(1), до любой работы с БД задачи или сетью.
+
+    Ключ события - источник, ID задачи и статус. С Redis это SET NX с TTL,
+    без Redis - INSERT ... ON CONFLICT DO NOTHING в processed_webhook_event.
+    Если обработка первой доставки упала, ключ снимается через release(),
+    чтобы повтор от Replicate/воркера отработал заново. Строки таблицы старше TTL
+    удаляет purge_expired() (из фоновой очистки), как Redis удаляет ключи сам.
+
+    Это только дешевый фильтр точных повторов: разные терминальные статусы одной
+    задачи имеют разные ключи. Кто именно завершает задачу, решает условный
+    UPDATE ... WHERE status='pending' в месте расчета, а не этот ключ.
+    """
+
+    def __init__(self, redis_client, ttl):
+        self._redis = redis_client
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    @staticmethod
+    def _key(source, event_id, status):
+        return f"{source}:{event_id}:{status}"
+
+    def first_delivery(self, source, event_id, status):
+        key = self._key(source, event_id, status)
+        if self._redis:
+            is_first = bool(self._redis.set(f"{WEBHOOK_DEDUP_PREFIX}{key}", '1', nx=True, ex=self._ttl))
+        else:
+            values = {'key': key, 'created_at': datetime.utcnow()}
+            if db.engine.dialect.name == 'postgresql':
+                statement = postgresql_insert(ProcessedWebhookEvent.__table__).values(**values).on_conflict_do_nothing()
+            else:
+                statement = sqlite_insert(ProcessedWebhookEvent.__table__).values(**values).on_conflict_do_nothing()
+            is_first = db.session.execute(statement).rowcount == 1
             db.session.commit()
-        
-            prediction_replicate = replicate.predictions.create(
-                version=model_version_id,
-                input=replicate_input,
-                webhook=url_for('replicate_webhook', _external=True),
-                webhook_events_filter=["completed"]
-            )
-        
-            new_prediction.replicate_id = prediction_replicate.id
+        with self._lock:
+            counters = self._stats.setdefault(source, {'processed': 0, 'duplicates_dropped': 0})
+            counters['processed' if is_first else 'duplicates_dropped'] += 1
+        if not is_first:
+            log.info("Повторный вебхук отброшен", extra={'webhook_key': key, 'sampled': True})
+        return is_first
+
+    def release(self, source, event_id, status):
+        key = self._key(source, event_id, status)
+        if self._redis:
+            self._redis.delete(f"{WEBHOOK_DEDUP_PREFIX}{key}")
+            return
+        db.session.rollback()
+        ProcessedWebhookEvent.query.filter_by(key=key).delete()
+        db.session.commit()
+
+    def purge_expired(self, batch_size=WEBHOOK_DEDUP_PURGE_BATCH_SIZE):
+        """Удаляет из processed_webhook_event записи старше TTL пачками. Возвращает число удаленных."""
+        if self._redis:
+            return 0
+        table = ProcessedWebhookEvent.__table__
+        cutoff = datetime.utcnow() - timedelta(seconds=self._ttl)
+        purged = 0
+        while True:
+            expired_keys = db.select(table.c.key).where(table.c.created_at < cutoff).limit(batch_size)
+            deleted = db.session.execute(table.delete().where(table.c.key.in_(expired_keys.scalar_subquery()))).rowcount
             db.session.commit()
-        
-            return jsonify({'prediction_id': new_prediction.id, 'new_token_balance': user.token_balance}), 202
-        
+            purged += deleted
+            if deleted < batch_size:
+                break
+        if purged:
+            log.info("Старые записи дедупликации вебхуков удалены", extra={'purged': purged})
+        return purged
+
+    def stats(self):
+        with self._lock:
+            return {source: dict(counters) for source, counters in self._stats.items()}
+
+
+webhook_deduplicator = WebhookDeduplicator(redis_client, WEBHOOK_DEDUP_TTL)
+
+
+# --- Асинхронная обработка результатов Replicate (ingest) ---
+def ingest_replicate_result(job):
+    """Скачивает результат Replicate, перекладывает его в S3 и фиксирует статус в БД.
+
+    Идемпотентна по replicate_id: на время обработки берется блокировка, а
+    финальный статус пишется условным UPDATE ... WHERE status = 'pending',
+    поэтому повторная доставка вебхука не перекачивает картинку и не
+    возвращает токены дважды.
+    """
+    replicate_id = job.get('replicate_id')
+    status = job.get('status')
+    if not ingest_locks.acquire(replicate_id):
+        log.info("Ingest уже выполняется, пропускаем дубликат", extra={'replicate_id': replicate_id})
+        return
+    try:
+        prediction = Prediction.query.filter_by(replicate_id=replicate_id).first()
+        if not prediction:
+            log.warning("Вебхук для неизвестного Replicate ID", extra={'replicate_id': replicate_id})
+            # Вебхук мог обогнать коммит replicate_id - повтор от Replicate должен пройти
+            db.session.rollback()
+            webhook_deduplicator.release('replicate', replicate_id, status)
+            return
+        if prediction.status != 'pending':
+            log.info("Задача уже завершена, повторный вебхук пропущен", extra={'prediction_id': prediction.id, 'status': prediction.status})
+            return
+        prediction_id, user_id, token_cost = prediction.id, prediction.user_id, prediction.token_cost
+        # Отпускаем соединение с БД на время скачивания и загрузки в S3
+        db.session.rollback()
+
+        if status not in ('succeeded', 'failed'):
+            return
+
+        output_url = None
+        refund = status == 'failed'
+        temp_url = job.get('output')
+        if temp_url and isinstance(temp_url, list): temp_url = temp_url[0]
+
+        if status == 'succeeded' and temp_url:
+            try:
+                file_extension = os.path.splitext(temp_url.split('?')[0])[-1] or '.png'
+                object_name = f"generations/{user_id}/{prediction_id}{file_extension}"
+
+                # Качаем результат чанками и сразу отдаем в S3, не держа всю картинку в памяти воркера
+                with requests.get(temp_url, stream=True, timeout=REPLICATE_DOWNLOAD_TIMEOUT) as image_response:
+                    image_response.raise_for_status()
+                    output_url = s3_storage.upload_stream(
+                        image_response.iter_content(chunk_size=REPLICATE_DOWNLOAD_CHUNK_SIZE), object_name,
+                        content_type=image_response.headers.get('Content-Type', 'image/png')
+                    )
+            except Exception as e:
+                log.error("Ошибка при скачивании/перезагрузке изображения из Replicate", extra={'error': str(e)})
+                refund = True
+
+        if output_url:
+            finalized = Prediction.query.filter_by(id=prediction_id, status='pending').update(
+                {'status': 'completed', 'output_url': output_url}, synchronize_session=False)
         else:
-            return jsonify({'error': 'Invalid mode specified'}), 400
+            finalized = Prediction.query.filter_by(id=prediction_id, status='pending').update(
+                {'status': 'failed'}, synchronize_session=False)
+            # Токены возвращаем только если именно этот вызов перевел задачу в failed
+            if finalized and refund:
+                refund_tokens(user_id, token_cost, prediction_id)
+        db.session.commit()
+        if finalized:
+            final_status = 'completed' if output_url else 'failed'
+            result_notifier.publish(user_id, prediction_id, final_status)
+            if output_url:
+                ingest_queue.enqueue({'type': 'thumbnail', 'prediction_id': prediction_id})
+            log.info("Результат Replicate зафиксирован", extra={'prediction_id': prediction_id, 'status': final_status})
+    finally:
+        ingest_locks.release(replicate_id)
 
-    except Exception as e:
+
+class ThumbnailSourceTooLarge(Exception):
+    """Исходник превью больше лимитов: превью не делаем, архив показывает оригинал."""
+
+
+def _make_thumbnail_bytes(source_file, max_dimension, max_pixels):
+    # Image.open читает только заголовок, так что размер проверяем до декодирования
+    try:
+        img = Image.open(source_file)
+    except Image.DecompressionBombError as e:
+        raise ThumbnailSourceTooLarge(str(e))
+    width, height = img.size
+    if width * height > max_pixels:
+        raise ThumbnailSourceTooLarge(f"{width}x{height} exceeds {max_pixels} pixels")
+    img.draft('RGB', (max_dimension, max_dimension))
+    img.thumbnail((max_dimension, max_dimension))
+    if img.mode not in ('RGB', 'RGBA'):
+        img = img.convert('RGBA' if 'A' in img.getbands() else 'RGB')
+    byte_arr = io.BytesIO()
+    img.save(byte_arr, format='WEBP', quality=80)
+    return byte_arr.getvalue()
+
+
+def generate_prediction_thumbnail(job):
+    """Делает превью для архива из готового результата и сохраняет ссылку на него в Prediction."""
+    prediction_id = job['prediction_id']
+    prediction = Prediction.query.get(prediction_id)
+    if not prediction or prediction.status != 'completed' or prediction.thumbnail_url:
+        return
+    user_id, source_url = prediction.user_id, prediction.output_url
+    db.session.rollback()
+
+    # Исходник (апскейл - десятки МБ) качаем чанками во временный файл, а не в память воркера
+    with tempfile.TemporaryFile() as source_file:
+        try:
+            _download_to_file(source_url, source_file, THUMBNAIL_MAX_SOURCE_BYTES)
+            source_file.seek(0)
+            thumbnail_data = image_pool.run(_make_thumbnail_bytes, source_file, THUMBNAIL_MAX_DIMENSION, THUMBNAIL_MAX_SOURCE_PIXELS)
+        except ThumbnailSourceTooLarge as e:
+            # Повтор ничего не изменит: помечаем, что превью - сам оригинал, чтобы бэкфилл его не трогал
+            log.info("Исходник слишком большой, превью не делаем", extra={'prediction_id': prediction_id, 'reason': str(e)})
+            thumbnail_url = source_url
+        else:
+            thumbnail_url = s3_storage.upload_fileobj(io.BytesIO(thumbnail_data), f"generations/{user_id}/{prediction_id}_thumb.webp", content_type='image/webp')
+    Prediction.query.filter_by(id=prediction_id).update({'thumbnail_url': thumbnail_url}, synchronize_session=False)
+    db.session.commit()
+
+
+def _download_to_file(url, target, max_bytes):
+    with requests.get(url, stream=True, timeout=REPLICATE_DOWNLOAD_TIMEOUT) as response:
+        response.raise_for_status()
+        declared = response.headers.get('Content-Length')
+        if declared and declared.isdigit() and int(declared) > max_bytes:
+            raise ThumbnailSourceTooLarge(f"{declared} bytes exceeds {max_bytes}")
+        written = 0
+        for chunk in response.iter_content(chunk_size=REPLICATE_DOWNLOAD_CHUNK_SIZE):
+            written += len(chunk)
+            if written > max_bytes:
+                raise ThumbnailSourceTooLarge(f"more than {max_bytes} bytes")
+            target.write(chunk)
+
+
+def backfill_thumbnails(batch_size, limit=None):
+    """Делает превью для завершенных задач, созданных до появления thumbnail_url.
+
+    Идет по id пачками; каждая задача обрабатывается тем же generate_prediction_thumbnail,
+    ошибка одной задачи не останавливает остальные.
+    """
+    summary = {'processed': 0, 'failed': 0}
+    last_id = ''
+    while limit is None or summary['processed'] + summary['failed'] < limit:
+        size = batch_size if limit is None else min(batch_size, limit - summary['processed'] - summary['failed'])
+        ids = db.session.scalars(
+            db.select(Prediction.id)
+            .where(Prediction.status == 'completed', Prediction.thumbnail_url.is_(None), Prediction.id > last_id)
+            .order_by(Prediction.id).limit(size)
+        ).all()
         db.session.rollback()
-        import traceback
-        traceback.print_exc()
-        return jsonify({'error': f'An internal server error occurred: {str(e)}'}), 500
+        if not ids:
+            break
+        for prediction_id in ids:
+            try:
+                generate_prediction_thumbnail({'prediction_id': prediction_id})
+                summary['processed'] += 1
+            except Exception as e:
+                db.session.rollback()
+                summary['failed'] += 1
+                log.warning("Не удалось сделать превью при бэкфилле", extra={'prediction_id': prediction_id, 'error': str(e)})
+        last_id = ids[-1]
+        log.info("Бэкфилл превью: пачка обработана", extra=dict(summary))
+    return summary
+
+
+INGEST_JOB_HANDLERS = {
+    'replicate_result': ingest_replicate_result,
+    'thumbnail': generate_prediction_thumbnail,
+}
+
+
+class IngestLocks:
+    """Блокировки ingest по replicate_id: в Redis (между процессами) или в памяти процесса."""
+
+    def __init__(self, redis_client):
+        self._redis = redis_client
+        self._local = set()
+        self._local_lock = threading.Lock()
+
+    def acquire(self, replicate_id):
+        if self._redis:
+            return bool(self._redis.set(f"{INGEST_LOCK_PREFIX}{replicate_id}", '1', nx=True, ex=INGEST_LOCK_TTL))
+        with self._local_lock:
+            if replicate_id in self._local:
+                return False
+            self._local.add(replicate_id)
+            return True
 
+    def release(self, replicate_id):
+        if self._redis:
+            self._redis.delete(f"{INGEST_LOCK_PREFIX}{replicate_id}")
+            return
+        with self._local_lock:
+            self._local.discard(replicate_id)
+
+
+class IngestQueue:
+    """Очередь ingest-задач: Redis-список, а без REDIS_URL - очередь внутри процесса.
+
+    В режиме INGEST_CONSUMER_MODE=embedded (по умолчанию) каждый веб-воркер,
+    поставивший задачу, поднимает у себя фоновый потребитель (greenlet после
+    monkey.patch_all). В режиме external задачи из Redis разбирает отдельный
+    процесс: `flask --app app ingest-worker`.
+
+    Короткоживущие CLI-команды включают inline: задача выполняется сразу в вызывающем
+    потоке. Иначе без Redis она пропала бы вместе с процессом, а с Redis команда
+    подняла бы свой потребитель, который может взять чужую задачу и умереть на середине.
+    """
+
+    def __init__(self, redis_client):
+        self._redis = redis_client
+        self._local_queue = queue.Queue()
+        self._consumer_started = False
+        self._start_lock = threading.Lock()
+        self.inline = False
+
+    def enqueue(self, job):
+        job.setdefault('attempts', 0)
+        if self.inline:
+            self.process(job)
+        elif self._redis:
+            self._redis.lpush(INGEST_QUEUE_KEY, json.dumps(job))
+            if INGEST_CONSUMER_MODE == 'embedded':
+                self._ensure_consumer()
+        else:
+            self._local_queue.put(job)
+            self._ensure_consumer()
+
+    def _ensure_consumer(self):
+        if self._consumer_started:
+            return
+        with self._start_lock:
+            if self._consumer_started:
+                return
+            threading.Thread(target=self.run_forever, name='ingest-consumer', daemon=True).start()
+            self._consumer_started = True
+
+    def _next_job(self, timeout):
+        if self._redis:
+            item = self._redis.brpop(INGEST_QUEUE_KEY, timeout=timeout)
+            return json.loads(item[1]) if item else None
+        try:
+            return self._local_queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def run_forever(self):
+        while True:
+            try:
+                job = self._next_job(timeout=5)
+            except Exception as e:
+                log.error("Ошибка чтения очереди ingest", extra={'error': str(e)})
+                time.sleep(1)
+                continue
+            if job:
+                self.process(job)
+
+    def process(self, job):
+        with app.app_context():
+            job_id = job.get('replicate_id') or job.get('prediction_id')
+            job_type = job.get('type', 'replicate_result')
+            try:
+                with log_context(job_type=job_type, replicate_id=job.get('replicate_id'), prediction_id=job.get('prediction_id')), \
+                        metrics.span('pifly_webhook_stage_seconds', route='ingest', stage=job_type):
+                    INGEST_JOB_HANDLERS[job_type](job)
+            except Exception as e:
+                db.session.rollback()
+                job['attempts'] = job.get('attempts', 0) + 1
+                if job['attempts'] < INGEST_MAX_ATTEMPTS:
+                    log.warning("Ingest упал, повторяем", extra={'job_id': job_id, 'error': str(e), 'attempt': job['attempts']})
+                    self.enqueue(job)
+                else:
+                    log.exception("Ingest окончательно не удался", extra={'job_id': job_id, 'attempt': job['attempts']})
+
+
+ingest_locks = IngestLocks(redis_client)
+ingest_queue = IngestQueue(redis_client)
+
+
+@app.cli.command('ingest-worker')
+def ingest_worker_command():
+    """Отдельный процесс-потребитель очереди ingest (для INGEST_CONSUMER_MODE=external)."""
+    if not redis_client:
+        raise SystemExit("REDIS_URL is not configured; ingest runs in-process in web workers.")
+    print(f">>> Ingest-воркер слушает очередь {INGEST_QUEUE_KEY}.")
+    ingest_queue.run_forever()
+
+
+@app.cli.command('backfill-thumbnails')
+@click.option('--batch-size', type=int, default=THUMBNAIL_BACKFILL_BATCH_SIZE, show_default=True)
+@click.option('--limit', type=int, default=None, help='Обработать не больше N задач.')
+def backfill_thumbnails_command(batch_size, limit):
+    """Делает превью для старых задач без thumbnail_url."""
+    summary = backfill_thumbnails(batch_size, limit)
+    print(f">>> Превью: сделано {summary['processed']}, ошибок {summary['failed']}.")
 
 
 @app.route('/replicate-webhook', methods=['POST'])
@@ -1021,53 +2818,209 @@ def replicate_webhook():
 
     if not replicate_id:
         return 'Invalid payload, missing ID', 400
+    bind_log_context(replicate_id=replicate_id)
 
-    with app.app_context():
-        prediction = Prediction.query.filter_by(replicate_id=replicate_id).first()
-        if not prediction:
-            print(f"!!! Вебхук получен для неизвестного Replicate ID: {replicate_id}")
-            return 'Prediction not found', 404
+    with metrics.span('pifly_webhook_stage_seconds', route='replicate_webhook', stage='dedup'):
+        is_first = webhook_deduplicator.first_delivery('replicate', replicate_id, status)
+    if not is_first:
+        return 'Duplicate webhook ignored', 200
 
-        if status == 'succeeded':
-            temp_url = data.get('output')
-            if temp_url and isinstance(temp_url, list): temp_url = temp_url[0]
-            
-            if temp_url:
-                try:
-                    image_response = requests.get(temp_url, stream=True)
-                    image_response.raise_for_status()
-                    image_data = io.BytesIO(image_response.content)
-                    s3_client = boto3.client('s3', region_name=AWS_S3_REGION, aws_access_key_id=AWS_ACCESS_KEY_ID, aws_secret_access_key=AWS_SECRET_ACCESS_KEY)
-                    file_extension = os.path.splitext(temp_url.split('?')[0])[-1] or '.png'
-                    object_name = f"generations/{prediction.user_id}/{prediction.id}{file_extension}"
-                    
-                    s3_client.upload_fileobj(
-                        image_data, AWS_S3_BUCKET_NAME, object_name,
-                        ExtraArgs={'ContentType': image_response.headers.get('Content-Type', 'image/png')}
-                    )
-                    
-                    permanent_s3_url = f"https://{AWS_S3_BUCKET_NAME}.s3.{AWS_S3_REGION}.amazonaws.com/{object_name}"
-                    prediction.output_url = permanent_s3_url
-                    prediction.status = 'completed'
+    # Только ставим задачу в очередь: скачивание и запись в БД делает ingest-потребитель
+    try:
+        with metrics.span('pifly_webhook_stage_seconds', route='replicate_webhook', stage='enqueue'):
+            ingest_queue.enqueue({
+                'replicate_id': replicate_id,
+                'status': status,
+                'output': data.get('output'),
+                'error': data.get('error'),
+            })
+    except Exception:
+        webhook_deduplicator.release('replicate', replicate_id, status)
+        raise
+    return 'Webhook received', 200
 
+
+# --- Фоновая сверка статусов Replicate ---
+def hold_leadership(redis_client, key, token, ttl):
+    """Простое лидерство по Redis-ключу: True, если ключ наш (взяли или продлили). Без Redis лидер - всегда мы."""
+    if not redis_client:
+        return True
+    if redis_client.set(key, token, nx=True, ex=ttl):
+        return True
+    if (redis_client.get(key) or b'').decode() == token:
+        redis_client.expire(key, ttl)
+        return True
+    return False
+
+
+class ReplicateStatusPoller:
+    """Единый фоновый опрос Replicate для всех pending-задач.
+
+    Раз в REPLICATE_RECONCILE_INTERVAL секунд один процесс (лидер по Redis-ключу)
+    забирает пачку pending-задач, получает их статусы одним запросом списка
+    /v1/predictions (точечные запросы - только для тех, кого нет в списке) и
+    кладет их в кэш с коротким TTL. Эндпоинты результатов читают только кэш.
+    Завершившиеся задачи передаются в ingest, который идемпотентно фиксирует
+    результат или возвращает токены.
+    """
+
+    def __init__(self, redis_client):
+        self._redis = redis_client
+        self._local_cache = {}
+        self._settled = {}
+        self._lock = threading.Lock()
+        self._single_flight = SingleFlight()
+        self._rate_limiter = RateLimiter(REPLICATE_POLL_RATE_PER_SECOND, REPLICATE_POLL_BURST)
+        self._http = requests.Session()
+        self._started = False
+        self._leader_token = str(uuid.uuid4())
+        self.api_url = REPLICATE_API_URL
+
+    def ensure_started(self):
+        if self._started:
+            return
+        with self._lock:
+            if self._started:
+                return
+            threading.Thread(target=self.run_forever, name='replicate-reconciler', daemon=True).start()
+            self._started = True
+
+    def cached_status(self, replicate_id):
+        self.ensure_started()
+        if self._redis:
+            try:
+                raw = self._redis.get(f"{REPLICATE_STATUS_CACHE_PREFIX}{replicate_id}")
+                return json.loads(raw) if raw else None
+            except Exception as e:
+                log.warning("Ошибка чтения кэша статусов Replicate", extra={'error': str(e), 'sampled': True})
+                return None
+        with self._lock:
+            entry = self._local_cache.get(replicate_id)
+        if entry and entry[0] > time.monotonic():
+            return entry[1]
+        return None
+
+    def fetch_status(self, replicate_id):
+        """Один запрос статуса в Replicate; одновременные запросы одного ID склеиваются."""
+        def fetch():
+            self._rate_limiter.acquire()
+            response = self._http.get(f"{self.api_url}/predictions/{replicate_id}", headers=self._headers(), timeout=10)
+            response.raise_for_status()
+            status_data = response.json()
+            self._store(status_data)
+            return status_data
+        return self._single_flight.do(replicate_id, fetch)
+
+    def fetch_statuses(self, replicate_ids, errors=None):
+        """Статусы пачки задач: сначала страницы списка /v1/predictions, затем точечно - оставшиеся.
+
+        ID, которых Replicate не знает (404), в результат не попадают. ID, статус которых
+        не удалось получить (таймаут, 429, 5xx), тоже не попадают, но добавляются в errors.
+        """
+        wanted = set(replicate_ids)
+        found = {}
+        url = f"{self.api_url}/predictions"
+        for _ in range(REPLICATE_LIST_MAX_PAGES):
+            if not url or not wanted - set(found):
+                break
+            self._rate_limiter.acquire()
+            response = self._http.get(url, headers=self._headers(), timeout=10)
+            response.raise_for_status()
+            page = response.json()
+            for status_data in page.get('results', []):
+                if status_data.get('id') in wanted:
+                    found[status_data['id']] = status_data
+            url = page.get('next')
+        for status_data in found.values():
+            self._store(status_data)
+        for replicate_id in wanted - set(found):
+            try:
+                found[replicate_id] = self.fetch_status(replicate_id)
+            except requests.exceptions.RequestException as e:
+                response = getattr(e, 'response', None)
+                if response is not None and response.status_code == 404:
+                    continue
+                if errors is not None:
+                    errors.add(replicate_id)
+                log.warning("Ошибка опроса статуса Replicate", extra={'replicate_id': replicate_id, 'error': str(e)})
+        return found
+
+    def settle(self, status_data):
+        """Передает завершившуюся в Replicate задачу в ingest (не чаще раза в минуту на ID)."""
+        replicate_id = status_data.get('id')
+        status = status_data.get('status')
+        if status not in ('succeeded', 'failed', 'canceled'):
+            return
+        now = time.monotonic()
+        with self._lock:
+            if self._settled.get(replicate_id, 0) > now:
+                return
+            self._settled = {key: until for key, until in self._settled.items() if until > now}
+            self._settled[replicate_id] = now + 60
+        job = {
+            'replicate_id': replicate_id,
+            'status': 'succeeded' if status == 'succeeded' else 'failed',
+            'output': status_data.get('output'),
+            'error': status_data.get('error'),
+        }
+        if job['status'] == 'failed':
+            # Возврат токенов дешевый (без скачивания), делаем его сразу
+            ingest_replicate_result(job)
+        elif not status_data.get('output'):
+            # В списке /v1/predictions поля output может не быть - дозапросим задачу целиком
+            with self._lock:
+                self._settled.pop(replicate_id, None)
+            self.settle(self.fetch_status(replicate_id))
+        else:
+            ingest_queue.enqueue(job)
+
+    def reconcile_once(self):
+        with app.app_context():
+            pending = db.session.query(Prediction.replicate_id).filter(
+                Prediction.status == 'pending',
+                Prediction.replicate_id.isnot(None),
+            ).order_by(Prediction.created_at.desc()).limit(REPLICATE_RECONCILE_BATCH_SIZE).all()
+            db.session.remove()
+            if not pending:
+                return
+            statuses = self.fetch_statuses([row.replicate_id for row in pending])
+            for status_data in statuses.values():
+                try:
+                    self.settle(status_data)
                 except Exception as e:
-                    print(f"!!! Ошибка при скачивании/перезагрузке изображения из Replicate: {e}")
-                    prediction.status = 'failed'
-                    user = User.query.get(prediction.user_id)
-                    if user: user.token_balance += prediction.token_cost
-            else:
-                prediction.status = 'failed'
-
-        elif status == 'failed':
-            prediction.status = 'failed'
-            user = User.query.get(prediction.user_id)
-            if user:
-                user.token_balance += prediction.token_cost
-            print(f"!!! Вебхук обработан для Prediction {prediction.id}. Статус: failed. Токены возвращены.")
-            
-        db.session.commit()
-        
-    return 'Webhook received', 200
+                    db.session.rollback()
+                    log.exception("Не удалось завершить задачу Replicate", extra={'replicate_id': status_data.get('id')})
+
+    def run_forever(self):
+        while True:
+            time.sleep(REPLICATE_RECONCILE_INTERVAL)
+            try:
+                if self._is_leader():
+                    self.reconcile_once()
+            except Exception as e:
+                log.exception("Ошибка фоновой сверки статусов Replicate")
+
+    def _is_leader(self):
+        return hold_leadership(self._redis, 'pifly_replicate_reconciler_leader', self._leader_token, REPLICATE_RECONCILE_INTERVAL * 3)
+
+    def _store(self, status_data):
+        replicate_id = status_data.get('id')
+        if not replicate_id:
+            return
+        if self._redis:
+            self._redis.set(f"{REPLICATE_STATUS_CACHE_PREFIX}{replicate_id}", json.dumps(status_data), ex=REPLICATE_STATUS_TTL)
+            return
+        with self._lock:
+            now = time.monotonic()
+            if len(self._local_cache) > 10000:
+                self._local_cache = {key: entry for key, entry in self._local_cache.items() if entry[0] > now}
+            self._local_cache[replicate_id] = (now + REPLICATE_STATUS_TTL, status_data)
+
+    def _headers(self):
+        return {"Authorization": f"Bearer {REPLICATE_API_TOKEN}", "Content-Type": "application/json"}
+
+
+replicate_status_poller = ReplicateStatusPoller(redis_client)
 
 
 # --- Главный маршрут и выход ---
@@ -1084,10 +3037,260 @@ def logout():
     flash('You have been logged out.', 'success')
     return redirect(url_for('login'))
 
+# --- Надежная очередь задач Autofix ---
+_EDIT_QUEUE_CLAIM_SCRIPT = """
+local lanes = #KEYS - 3
+for i = 1, lanes do
+  local job = redis.call('RPOP', KEYS[i])
+  if job then
+    local prediction_id = cjson.decode(job)['prediction_id']
+    redis.call('ZADD', KEYS[lanes + 1], ARGV[1], prediction_id)
+    redis.call('HSET', KEYS[lanes + 2], prediction_id, job)
+    local attempts = redis.call('HINCRBY', KEYS[lanes + 3], prediction_id, 1)
+    return {job, attempts}
+  end
+end
+return false
+"""
+
+_EDIT_QUEUE_EXPIRE_SCRIPT = """
+if redis.call('ZREM', KEYS[1], ARGV[1]) == 0 then
+  return false
+end
+local job = redis.call('HGET', KEYS[2], ARGV[1])
+redis.call('HDEL', KEYS[2], ARGV[1])
+if not job then
+  redis.call('HDEL', KEYS[3], ARGV[1])
+  return false
+end
+local attempts = tonumber(redis.call('HGET', KEYS[3], ARGV[1]) or '0')
+if attempts >= tonumber(ARGV[2]) then
+  redis.call('HDEL', KEYS[3], ARGV[1])
+  redis.call('LPUSH', KEYS[4], job)
+  return {'dead', job}
+end
+redis.call('RPUSH', ARGV[3] .. (cjson.decode(job)['lane'] or 'free'), job)
+return {'requeued', job}
+"""
+
+
+class EditJobQueue:
+    """Очередь задач для внешнего воркера Autofix с подтверждением и таймаутом видимости.
+
+    Задачи лежат в списках по планам (pro > best > taste > free). Выдача воркеру
+    атомарно (Lua) переносит задачу в in-flight: ZSET с дедлайном + payload в хэше.
+    Вебхук воркера о завершении подтверждает задачу. Если дедлайн прошел, задача
+    возвращается в начало своей очереди, а после EDIT_QUEUE_MAX_ATTEMPTS попыток
+    уходит в dead-letter, Prediction помечается failed и токены возвращаются.
+
+    Переход со старого протокола (воркер делает BRPOP из EDIT_QUEUE_LEGACY_KEY)
+    управляется EDIT_QUEUE_MODE:
+    1. legacy (по умолчанию) - задачи пишутся только в старый список, как раньше;
+    2. dual - пока выкатываются воркеры с claim/heartbeat, задачи пишутся и туда,
+       и в очереди по планам. Одну задачу могут взять оба воркера: лишний результат
+       отбросит условный UPDATE в worker_webhook, /worker/jobs/claim отдает только pending;
+    3. claim - когда старых воркеров не осталось и старый список пуст.
+    """
+
+    def __init__(self, redis_client, prefix, mode):
+        self._redis = redis_client
+        self._lane_prefix = prefix
+        self.mode = mode
+        self._inflight_key = f"{prefix}inflight"
+        self._payloads_key = f"{prefix}payloads"
+        self._attempts_key = f"{prefix}attempts"
+        self._dead_key = f"{prefix}dead"
+        self._scripts = None
+        self._lock = threading.Lock()
+        self._started = False
+
+    def lane_key(self, lane):
+        return f"{self._lane_prefix}{lane}"
+
+    def _script(self, name):
+        if self._scripts is None:
+            self._scripts = {
+                'claim': self._redis.register_script(_EDIT_QUEUE_CLAIM_SCRIPT),
+                'expire': self._redis.register_script(_EDIT_QUEUE_EXPIRE_SCRIPT),
+            }
+        return self._scripts[name]
+
+    def ensure_started(self):
+        if self._started:
+            return
+        with self._lock:
+            if self._started:
+                return
+            threading.Thread(target=self.run_sweeper, name='edit-queue-sweeper', daemon=True).start()
+            self._started = True
+
+    @property
+    def tracks_jobs(self):
+        """True, если задачи идут через очереди по планам и их состояние видно в Redis."""
+        return self.mode != 'legacy'
+
+    def enqueue(self, job, lane):
+        job = dict(job, lane=lane if lane in EDIT_QUEUE_LANES else 'free')
+        payload = json.dumps(job)
+        pipe = self._redis.pipeline()
+        if self.mode in ('legacy', 'dual'):
+            pipe.lpush(EDIT_QUEUE_LEGACY_KEY, payload)
+        if self.tracks_jobs:
+            pipe.lpush(self.lane_key(job['lane']), payload)
+        pipe.execute()
+        if self.tracks_jobs:
+            self.ensure_started()
+
+    def claim(self, wait=0):
+        """Выдает следующую задачу (с учетом приоритета) или None, если за wait секунд ничего не появилось."""
+        self.ensure_started()
+        keys = [self.lane_key(lane) for lane in EDIT_QUEUE_LANES] + [self._inflight_key, self._payloads_key, self._attempts_key]
+        deadline = time.time() + wait
+        while True:
+            claimed = self._script('claim')(keys=keys, args=[time.time() + EDIT_QUEUE_VISIBILITY_TIMEOUT])
+            if claimed:
+                job = json.loads(claimed[0])
+                job['attempt'] = int(claimed[1])
+                return job
+            if time.time() >= deadline:
+                return None
+            time.sleep(0.5)
+
+    def extend(self, prediction_id):
+        """Продлевает таймаут видимости для долгой задачи. False - задача уже не у этого воркера."""
+        return bool(self._redis.zadd(self._inflight_key, {prediction_id: time.time() + EDIT_QUEUE_VISIBILITY_TIMEOUT}, xx=True, ch=True))
+
+    def is_in_flight(self, prediction_id):
+        return self._redis.zscore(self._inflight_key, prediction_id) is not None
+
+    def tracked_ids(self):
+        """ID всех задач, которые ждут в очередях по планам или выданы воркеру."""
+        pipe = self._redis.pipeline()
+        pipe.zrange(self._inflight_key, 0, -1)
+        pipe.hkeys(self._payloads_key)
+        for lane in EDIT_QUEUE_LANES:
+            pipe.lrange(self.lane_key(lane), 0, -1)
+        inflight, payload_ids, *lanes = pipe.execute()
+        ids = {raw.decode() if isinstance(raw, bytes) else raw for raw in list(inflight) + list(payload_ids)}
+        for items in lanes:
+            ids.update(json.loads(item)['prediction_id'] for item in items)
+        return ids
+
+    def ack(self, prediction_id):
+        pipe = self._redis.pipeline()
+        pipe.zrem(self._inflight_key, prediction_id)
+        pipe.hdel(self._payloads_key, prediction_id)
+        pipe.hdel(self._attempts_key, prediction_id)
+        pipe.execute()
+
+    def sweep_once(self):
+        """Возвращает в очередь или отправляет в dead-letter задачи с истекшим дедлайном."""
+        expired = self._redis.zrangebyscore(self._inflight_key, '-inf', time.time(), start=0, num=100)
+        for raw_id in expired:
+            prediction_id = raw_id.decode() if isinstance(raw_id, bytes) else raw_id
+            # Скрипт сначала делает ZREM: задачу обрабатывает только тот процесс, чей ZREM прошел
+            outcome = self._script('expire')(
+                keys=[self._inflight_key, self._payloads_key, self._attempts_key, self._dead_key],
+                args=[prediction_id, EDIT_QUEUE_MAX_ATTEMPTS, self._lane_prefix],
+            )
+            if not outcome:
+                continue
+            action = outcome[0].decode() if isinstance(outcome[0], bytes) else outcome[0]
+            job = json.loads(outcome[1])
+            if action == 'dead':
+                log.error("Задача Autofix не подтверждена, отправлена в dead-letter", extra={'prediction_id': prediction_id, 'attempts': EDIT_QUEUE_MAX_ATTEMPTS})
+                self._fail_dead_job(job)
+            else:
+                log.warning("Таймаут задачи Autofix, возвращаем в очередь", extra={'prediction_id': prediction_id, 'lane': job.get('lane')})
+
+    def _fail_dead_job(self, job):
+        prediction_id, user_id = job['prediction_id'], job['user_id']
+        with app.app_context():
+            finalized = Prediction.query.filter_by(id=prediction_id, status='pending').update(
+                {'status': 'failed'}, synchronize_session=False)
+            if finalized:
+                refund_tokens(user_id, job['token_cost'], prediction_id)
+            db.session.commit()
+        if finalized:
+            result_notifier.publish(user_id, prediction_id, 'failed')
+
+    def run_sweeper(self):
+        while True:
+            time.sleep(EDIT_QUEUE_SWEEP_INTERVAL)
+            try:
+                self.sweep_once()
+            except Exception as e:
+                log.exception("Ошибка проверки таймаутов очереди Autofix")
+
+    def stats(self):
+        pipe = self._redis.pipeline()
+        for lane in EDIT_QUEUE_LANES:
+            pipe.llen(self.lane_key(lane))
+        pipe.zcard(self._inflight_key)
+        pipe.llen(self._dead_key)
+        pipe.llen(EDIT_QUEUE_LEGACY_KEY)
+        counts = pipe.execute()
+        return {
+            'mode': self.mode,
+            'lanes': dict(zip(EDIT_QUEUE_LANES, counts[:len(EDIT_QUEUE_LANES)])),
+            'inflight': counts[-3],
+            'dead_letter': counts[-2],
+            # Перед переключением в claim старый список должен опустеть
+            'legacy': counts[-1],
+        }
+
+
+edit_job_queue = EditJobQueue(redis_client, EDIT_QUEUE_PREFIX, EDIT_QUEUE_MODE)
+
+
+def worker_authorized():
+    auth_header = request.headers.get('Authorization')
+    return bool(WORKER_SECRET_KEY) and auth_header == f"Bearer {WORKER_SECRET_KEY}"
+
+
+@app.route('/worker/jobs/claim', methods=['POST'])
+def worker_claim_job():
+    """Воркер забирает следующую задачу. 204 - очередь пуста в течение wait секунд."""
+    if not worker_authorized():
+        return jsonify({'error': 'Unauthorized'}), 403
+    if not redis_client:
+        return jsonify({'error': 'Queue is not configured'}), 503
+    wait = min(max(float((request.get_json(silent=True) or {}).get('wait', 0)), 0), EDIT_QUEUE_CLAIM_MAX_WAIT)
+    while True:
+        job = edit_job_queue.claim(wait=wait)
+        if not job:
+            return '', 204
+        # Задача могла завершиться, пока лежала в очереди повторно - такую сразу подтверждаем
+        status = db.session.query(Prediction.status).filter_by(id=job['prediction_id']).scalar()
+        db.session.remove()
+        if status == 'pending':
+            job['visibility_timeout'] = EDIT_QUEUE_VISIBILITY_TIMEOUT
+            return jsonify(job), 200
+        edit_job_queue.ack(job['prediction_id'])
+        wait = 0
+
+
+@app.route('/worker/jobs/<prediction_id>/heartbeat', methods=['POST'])
+def worker_job_heartbeat(prediction_id):
+    if not worker_authorized():
+        return jsonify({'error': 'Unauthorized'}), 403
+    if not edit_job_queue.extend(prediction_id):
+        return jsonify({'error': 'Job is not in flight'}), 409
+    return jsonify({'status': 'extended', 'visibility_timeout': EDIT_QUEUE_VISIBILITY_TIMEOUT}), 200
+
+
+@app.route('/worker/jobs/stats', methods=['GET'])
+def worker_job_stats():
+    if not worker_authorized():
+        return jsonify({'error': 'Unauthorized'}), 403
+    if not redis_client:
+        return jsonify({'error': 'Queue is not configured'}), 503
+    return jsonify(edit_job_queue.stats()), 200
+
+
 @app.route('/worker-webhook', methods=['POST'])
 def worker_webhook():
-    auth_header = request.headers.get('Authorization')
-    if not auth_header or auth_header != f"Bearer {WORKER_SECRET_KEY}":
+    if not worker_authorized():
         return jsonify({'error': 'Unauthorized'}), 403
 
     data = request.json
@@ -1096,31 +3299,531 @@ def worker_webhook():
     if not prediction_id or not status:
         return jsonify({'error': 'Missing prediction_id or status'}), 400
 
-    with app.app_context():
-        prediction = Prediction.query.get(prediction_id)
-        if not prediction:
-            print(f"!!! Воркер-вебхук получен для неизвестного Prediction ID: {prediction_id}")
-            return 'Prediction not found', 404
-
-        if status == 'completed':
-            final_url = data.get('final_url')
-            if not final_url: return jsonify({'error': 'Missing final_url'}), 400
-            prediction.output_url = final_url
-            prediction.status = 'completed'
-            print(f">>> РЕЗУЛЬТАТ PRO-ЗАДАЧИ {prediction_id} УСПЕШНО СОХРАНЕН ЧЕРЕЗ ВЕБХУК.")
-        elif status == 'failed':
-            prediction.status = 'failed'
-            user = User.query.get(prediction.user_id)
-            if user:
-                user.token_balance += prediction.token_cost
-                print(f">>> ТОКЕНЫ ДЛЯ PRO-ЗАДАЧИ {prediction_id} ВОЗВРАЩЕНЫ ЧЕРЕЗ ВЕБХУК.")
-        db.session.commit()
+    bind_log_context(prediction_id=prediction_id)
+    final_url = data.get('final_url')
+    if status == 'completed' and not final_url:
+        return jsonify({'error': 'Missing final_url'}), 400
+    with metrics.span('pifly_webhook_stage_seconds', route='worker_webhook', stage='dedup'):
+        is_first = webhook_deduplicator.first_delivery('worker', prediction_id, status)
+    if not is_first:
+        return jsonify({'status': 'duplicate'}), 200
+
+    try:
+        with metrics.span('pifly_webhook_stage_seconds', route='worker_webhook', stage='db_update'):
+            prediction = Prediction.query.get(prediction_id)
+            if not prediction:
+                log.warning("Воркер-вебхук для неизвестной задачи")
+                # Строка может появиться позже - повтор не должен отсечься как дубликат
+                db.session.rollback()
+                webhook_deduplicator.release('worker', prediction_id, status)
+                return 'Prediction not found', 404
+
+            # Как и в ingest_replicate_result: переводим только из pending, чтобы запоздавший
+            # failed после completed (или completed после reap с возвратом) ничего не менял
+            finalized = 0
+            if status == 'completed':
+                finalized = Prediction.query.filter_by(id=prediction_id, status='pending').update(
+                    {'status': 'completed', 'output_url': final_url}, synchronize_session=False)
+                if finalized:
+                    log.info("Результат PRO-задачи сохранен через вебхук")
+            elif status == 'failed':
+                finalized = Prediction.query.filter_by(id=prediction_id, status='pending').update(
+                    {'status': 'failed'}, synchronize_session=False)
+                if finalized and refund_tokens(prediction.user_id, prediction.token_cost, prediction.id) is not None:
+                    log.info("Токены за PRO-задачу возвращены через вебхук")
+            if not finalized and status in ('completed', 'failed'):
+                log.info("Задача уже не pending, статус из вебхука воркера пропущен",
+                         extra={'status': prediction.status, 'webhook_status': status})
+            db.session.commit()
+    except Exception:
+        db.session.rollback()
+        webhook_deduplicator.release('worker', prediction_id, status)
+        raise
+    if status not in ('completed', 'failed'):
+        return jsonify({'status': 'success'}), 200
+    if redis_client:
+        # Задача воркера закончена при любом исходе - снимаем ее из inflight
+        edit_job_queue.ack(prediction_id)
+    if not finalized:
+        # Конфликтующий терминальный статус: уведомление и миниатюра уже сделаны тем, кто завершил задачу
+        return jsonify({'status': 'ignored'}), 200
+    result_notifier.publish(prediction.user_id, prediction_id, status)
+    if status == 'completed':
+        ingest_queue.enqueue({'type': 'thumbnail', 'prediction_id': prediction_id})
 
     return jsonify({'status': 'success'}), 200
 
-# --- Final app setup ---
-with app.app_context():
-    db.create_all()
+# --- Очистка зависших задач ---
+def reap_stuck_predictions(older_than_seconds, batch_size, dry_run=False):
+    """Доводит до конца pending-задачи, для которых так и не пришел вебхук.
+
+    Идет от самых старых задач пачками по (created_at, id). Для задач Replicate статусы
+    пачки берутся одним запросом списка: завершившиеся уходят в обычный ingest, неизвестные
+    Replicate (404) и работающие дольше PREDICTION_REAPER_HARD_TIMEOUT помечаются failed с возвратом
+    токенов. Задачи, статус которых Replicate сейчас не отдал (таймаут, 429), считаются работающими.
+    Задачи Autofix, которые ждут в очереди или у воркера, не трогаем до жесткого таймаута.
+    """
+    now = datetime.utcnow()
+    cutoff = now - timedelta(seconds=older_than_seconds)
+    hard_cutoff = now - timedelta(seconds=PREDICTION_REAPER_HARD_TIMEOUT)
+    summary = {'scanned': 0, 'settled': 0, 'failed': 0, 'still_running': 0}
+    cursor = None
+    while True:
+        query = db.session.query(Prediction.id, Prediction.user_id, Prediction.replicate_id,
+                                 Prediction.token_cost, Prediction.created_at).filter(
+            Prediction.status == 'pending', Prediction.created_at < cutoff)
+        if cursor:
+            query = query.filter(db.or_(
+                Prediction.created_at > cursor[0],
+                db.and_(Prediction.created_at == cursor[0], Prediction.id > cursor[1]),
+            ))
+        rows = query.order_by(Prediction.created_at.asc(), Prediction.id.asc()).limit(batch_size).all()
+        # Соединение с БД не держим, пока ходим в Replicate
+        db.session.rollback()
+        if not rows:
+            break
+        cursor = (rows[-1].created_at, rows[-1].id)
+        summary['scanned'] += len(rows)
+
+        replicate_ids = [row.replicate_id for row in rows if row.replicate_id]
+        fetch_errors = set()
+        statuses = replicate_status_poller.fetch_statuses(replicate_ids, errors=fetch_errors) if replicate_ids else {}
+        queued_edit_jobs = _queued_edit_job_ids() if len(replicate_ids) < len(rows) else None
+        to_fail = []
+        for row in rows:
+            if row.replicate_id:
+                status_data = statuses.get(row.replicate_id)
+                if status_data and status_data.get('status') in ('succeeded', 'failed', 'canceled'):
+                    summary['settled'] += 1
+                    if not dry_run:
+                        replicate_status_poller.settle(status_data)
+                    continue
+                still_running = status_data is not None or row.replicate_id in fetch_errors
+            else:
+                # None - очередь без учета задач (нет Redis или EDIT_QUEUE_MODE=legacy): ждем жесткого таймаута
+                still_running = queued_edit_jobs is None or row.id in queued_edit_jobs
+            if still_running and row.created_at >= hard_cutoff:
+                summary['still_running'] += 1
+            else:
+                to_fail.append(row)
+
+        summary['failed'] += len(to_fail)
+        if to_fail and not dry_run:
+            _fail_predictions_bulk(to_fail)
+        if len(rows) < batch_size:
+            break
+
+    log.info("Очистка зависших задач", extra={'dry_run': dry_run, **summary})
+    return summary
+
+
+def _queued_edit_job_ids():
+    if not redis_client or not edit_job_queue.tracks_jobs:
+        return None
+    return edit_job_queue.tracked_ids()
+
+
+def _fail_predictions_bulk(rows):
+    """Один UPDATE на пачку; токены возвращаем одной операцией на пользователя."""
+    failed_ids = {row.id for row in db.session.execute(
+        db.update(Prediction)
+        .where(Prediction.id.in_([row.id for row in rows]), Prediction.status == 'pending')
+        .values(status='failed')
+        .returning(Prediction.id)
+    )}
+    refunds = defaultdict(int)
+    for row in rows:
+        # Запись в журнале уникальна по (prediction_id, kind): повторный возврат невозможен
+        if row.id in failed_ids and _insert_ledger_entry_once(row.user_id, row.id, 'refund', row.token_cost):
+            refunds[row.user_id] += row.token_cost
+    for user_id, amount in refunds.items():
+        metrics.inc('pifly_tokens_refunded_total', amount)
+        _apply_balance_delta(user_id, amount)
+    db.session.commit()
+    for row in rows:
+        if row.id in failed_ids:
+            result_notifier.publish(row.user_id, row.id, 'failed')
+
+
+class PredictionReaper:
+    """Свое расписание для reap_stuck_predictions, независимое от опроса Replicate.
+
+    В режиме PREDICTION_REAPER_MODE=embedded поток поднимается в каждом веб-воркере
+    на первом запросе (так он переживает fork после --preload), а работает только
+    лидер по Redis-ключу. В режиме external очистку запускает отдельный процесс:
+    `flask --app app reap-predictions --loop`.
+    """
+
+    def __init__(self, redis_client, interval):
+        self._redis = redis_client
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._started = False
+        self._leader_token = str(uuid.uuid4())
+
+    def ensure_started(self):
+        if self._started:
+            return
+        with self._lock:
+            if self._started:
+                return
+            threading.Thread(target=self.run_forever, name='prediction-reaper', daemon=True).start()
+            self._started = True
+
+    def run_once(self, older_than_seconds=PREDICTION_REAPER_MIN_AGE, batch_size=PREDICTION_REAPER_BATCH_SIZE):
+        if not hold_leadership(self._redis, 'pifly_prediction_reaper_leader', self._leader_token, self._interval * 2):
+            return None
+        with app.app_context():
+            summary = reap_stuck_predictions(older_than_seconds, batch_size)
+            webhook_deduplicator.purge_expired()
+            return summary
+
+    def run_forever(self, older_than_seconds=PREDICTION_REAPER_MIN_AGE, batch_size=PREDICTION_REAPER_BATCH_SIZE):
+        while True:
+            time.sleep(self._interval)
+            try:
+                self.run_once(older_than_seconds, batch_size)
+            except Exception:
+                log.exception("Ошибка фоновой очистки зависших задач")
+
+
+prediction_reaper = PredictionReaper(redis_client, PREDICTION_REAPER_INTERVAL)
+
+
+@app.before_request
+def _start_prediction_reaper():
+    if PREDICTION_REAPER_MODE == 'embedded':
+        prediction_reaper.ensure_started()
+
+
+@app.cli.command('reap-predictions')
+@click.option('--older-than', type=int, default=PREDICTION_REAPER_MIN_AGE // 60, show_default=True,
+              help='Минимальный возраст pending-задачи в минутах.')
+@click.option('--batch-size', type=int, default=PREDICTION_REAPER_BATCH_SIZE, show_default=True)
+@click.option('--dry-run', is_flag=True, help='Только показать, что будет сделано.')
+@click.option('--loop', is_flag=True, help=f'Запускать каждые {PREDICTION_REAPER_INTERVAL} с (для PREDICTION_REAPER_MODE=external).')
+def reap_predictions_command(older_than, batch_size, dry_run, loop):
+    """Очистка зависших pending-задач: разово или по расписанию (--loop)."""
+    # Результаты Replicate докачиваем здесь же, без фонового потребителя ingest в этом процессе
+    ingest_queue.inline = True
+    if loop:
+        print(f">>> Очистка зависших задач каждые {PREDICTION_REAPER_INTERVAL} с.")
+        prediction_reaper.run_forever(older_than * 60, batch_size)
+        return
+    reap_stuck_predictions(older_than * 60, batch_size, dry_run=dry_run)
+
+
+# --- Эндпоинт метрик ---
+def _flatten_stats(prefix, stats):
+    for key, value in stats.items():
+        name = f"{prefix}.{key}" if prefix else key
+        if isinstance(value, dict):
+            yield from _flatten_stats(name, value)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield name, value
+
+
+@metrics.collector
+def _collect_component_stats():
+    components = {
+        's3': s3_storage.stats,
+        'image_pool': image_pool.stats,
+        'prompt_cache': prompt_cache.stats,
+        'api_token_cache': api_token_cache.stats,
+        'user_cache': user_projection_cache.stats,
+        'webhook_dedup': webhook_deduplicator.stats,
+        'services_init_ms': lambda: services.stats()['initialized'],
+    }
+    for component, stats in components.items():
+        for stat, value in _flatten_stats('', stats()):
+            yield 'pifly_component_stat', {'component': component, 'stat': stat}, value
+
+
+@metrics.collector
+def _collect_edit_queue():
+    if not redis_client:
+        return
+    stats = edit_job_queue.stats()
+    for lane, depth in stats['lanes'].items():
+        yield 'pifly_edit_queue_jobs', {'state': 'queued', 'lane': lane}, depth
+    yield 'pifly_edit_queue_jobs', {'state': 'inflight', 'lane': ''}, stats['inflight']
+    yield 'pifly_edit_queue_jobs', {'state': 'dead_letter', 'lane': ''}, stats['dead_letter']
+    yield 'pifly_edit_queue_jobs', {'state': 'legacy', 'lane': ''}, stats['legacy']
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    # Счетчики выручки и использования не должны быть видны публично: без токена эндпоинта как будто нет
+    if not METRICS_TOKEN:
+        abort(404)
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {METRICS_TOKEN}"):
+        return 'Unauthorized', 401
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+# --- Миграции схемы ---
+# Схема меняется только командой `flask db-upgrade` на шаге деплоя; воркеры при старте схему не трогают.
+# Базовая миграция создает зафиксированную схему (_baseline_metadata), а не текущие модели;
+# каждое изменение моделей после нее - отдельная миграция. Миграции идемпотентны (IF NOT EXISTS /
+# проверка колонки): базы, созданные еще create_all при импорте, уже могут содержать их изменения.
+MIGRATIONS_ADVISORY_LOCK_ID = 7240915
+
+schema_migrations = db.Table(
+    'schema_migrations',
+    db.Column('version', db.Integer, primary_key=True),
+    db.Column('name', db.String(255), nullable=False),
+    db.Column('applied_at', db.DateTime, nullable=False, default=datetime.utcnow),
+)
+
+MIGRATIONS = []
+
+
+def migration(version, online=False):
+    """Регистрирует миграцию. online=True - выполняется вне транзакции (CREATE INDEX CONCURRENTLY)."""
+    def decorator(fn):
+        MIGRATIONS.append((version, fn.__name__, fn, online))
+        return fn
+    return decorator
+
+
+def _create_index_online(connection, index):
+    if connection.dialect.name != 'postgresql':
+        index.create(bind=connection, checkfirst=True)
+        return
+    # Прерванный CREATE INDEX CONCURRENTLY оставляет невалидный индекс, который IF NOT EXISTS пропустил бы
+    invalid = connection.exec_driver_sql(
+        "SELECT 1 FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid WHERE c.relname = %(name)s AND NOT i.indisvalid",
+        {'name': index.name},
+    ).first()
+    if invalid:
+        connection.exec_driver_sql(f"DROP INDEX CONCURRENTLY IF EXISTS {index.name}")
+    ddl = str(CreateIndex(index, if_not_exists=True).compile(dialect=connection.dialect))
+    connection.exec_driver_sql(ddl.replace("CREATE INDEX", "CREATE INDEX CONCURRENTLY", 1))
+
+
+def _baseline_metadata():
+    """Схема на момент перехода на миграции (до thumbnail_url и индексов архива).
+
+    Зафиксирована отдельно от моделей: миграция 1 должна создавать одно и то же
+    независимо от того, как модели менялись потом. Не редактировать.
+    """
+    metadata = db.MetaData()
+    db.Table(
+        'user', metadata,
+        db.Column('id', db.String(128), primary_key=True),
+        db.Column('email', db.String(255), nullable=False),
+        db.Column('username', db.String(255), nullable=True),
+        db.Column('token_balance', db.Integer, nullable=False),
+        db.Column('marketing_consent', db.Boolean, nullable=False),
+        db.Column('subscription_status', db.String(50), nullable=False),
+        db.Column('stripe_customer_id', db.String(255), nullable=True, unique=True),
+        db.Column('stripe_subscription_id', db.String(255), nullable=True, unique=True),
+        db.Column('current_plan', db.String(50), nullable=True),
+        db.Column('trial_used', db.Boolean, nullable=False),
+        db.Column('subscription_ends_at', db.DateTime, nullable=True),
+        db.Index('ix_user_email', 'email', unique=True),
+    )
+    db.Table(
+        'prediction', metadata,
+        db.Column('id', db.String(36), primary_key=True),
+        db.Column('user_id', db.String(128), db.ForeignKey('user.id'), nullable=False),
+        db.Column('replicate_id', db.String(255), nullable=True),
+        db.Column('status', db.String(50), nullable=False),
+        db.Column('output_url', db.String(2048), nullable=True),
+        db.Column('created_at', db.DateTime, nullable=True),
+        db.Column('token_cost', db.Integer, nullable=False),
+        db.Index('ix_prediction_replicate_id', 'replicate_id', unique=True),
+    )
+    db.Table(
+        'used_trial_email', metadata,
+        db.Column('id', db.Integer, primary_key=True),
+        db.Column('email', db.String(255), nullable=False),
+        db.Index('ix_used_trial_email_email', 'email', unique=True),
+    )
+    db.Table(
+        'token_ledger_entry', metadata,
+        db.Column('id', db.Integer, primary_key=True),
+        db.Column('user_id', db.String(128), db.ForeignKey('user.id'), nullable=False),
+        db.Column('prediction_id', db.String(36), nullable=True),
+        db.Column('kind', db.String(32), nullable=False),
+        db.Column('amount', db.Integer, nullable=False),
+        db.Column('created_at', db.DateTime, nullable=False),
+        db.UniqueConstraint('prediction_id', 'kind', name='uq_token_ledger_prediction_kind'),
+        db.Index('ix_token_ledger_entry_user_id', 'user_id'),
+    )
+    db.Table(
+        'processed_webhook_event', metadata,
+        db.Column('key', db.String(255), primary_key=True),
+        db.Column('created_at', db.DateTime, nullable=False),
+    )
+    return metadata
+
+
+@migration(1)
+def baseline_schema(connection):
+    # checkfirst: базы, созданные еще create_all при импорте, уже содержат эти таблицы
+    _baseline_metadata().create_all(bind=connection, checkfirst=True)
+
+
+@migration(2)
+def add_prediction_thumbnail_url(connection):
+    columns = {column['name'] for column in db.inspect(connection).get_columns('prediction')}
+    if 'thumbnail_url' not in columns:
+        connection.execute(db.text("ALTER TABLE prediction ADD COLUMN thumbnail_url VARCHAR(2048)"))
+
+
+@migration(3, online=True)
+def add_prediction_hot_path_indexes(connection):
+    for index in Prediction.__table__.indexes:
+        if index.name in ('ix_prediction_archive', 'ix_prediction_pending_created'):
+            _create_index_online(connection, index)
+
+
+@migration(4, online=True)
+def drop_legacy_archive_index(connection):
+    concurrently = "CONCURRENTLY " if connection.dialect.name == 'postgresql' else ""
+    connection.exec_driver_sql(f"DROP INDEX {concurrently}IF EXISTS ix_prediction_user_status_created")
+
+
+@migration(5, online=True)
+def add_processed_webhook_event_created_at_index(connection):
+    for index in ProcessedWebhookEvent.__table__.indexes:
+        if index.name == 'ix_processed_webhook_event_created_at':
+            _create_index_online(connection, index)
+
+
+def run_migrations():
+    """Применяет недостающие миграции по порядку. Возвращает список примененных версий."""
+    engine = db.engine
+    applied_now = []
+    with engine.connect() as lock_connection:
+        if engine.dialect.name == 'postgresql':
+            # Два одновременных деплоя не должны катить миграции параллельно
+            lock_connection.exec_driver_sql(f"SELECT pg_advisory_lock({MIGRATIONS_ADVISORY_LOCK_ID})")
+            lock_connection.commit()
+        try:
+            with engine.begin() as connection:
+                schema_migrations.create(bind=connection, checkfirst=True)
+                applied = {row.version for row in connection.execute(db.select(schema_migrations.c.version))}
+
+            for version, name, fn, online in sorted(MIGRATIONS, key=lambda item: item[0]):
+                if version in applied:
+                    continue
+                print(f">>> Миграция {version}: {name}")
+                if online:
+                    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+                        fn(connection)
+                    with engine.begin() as connection:
+                        connection.execute(schema_migrations.insert().values(version=version, name=name, applied_at=datetime.utcnow()))
+                else:
+                    with engine.begin() as connection:
+                        fn(connection)
+                        connection.execute(schema_migrations.insert().values(version=version, name=name, applied_at=datetime.utcnow()))
+                applied_now.append(version)
+        finally:
+            if engine.dialect.name == 'postgresql':
+                lock_connection.exec_driver_sql(f"SELECT pg_advisory_unlock({MIGRATIONS_ADVISORY_LOCK_ID})")
+                lock_connection.commit()
+    return applied_now
+
+
+@app.cli.command('db-upgrade')
+def db_upgrade_command():
+    """Шаг деплоя: применить миграции схемы."""
+    applied = run_migrations()
+    print(f">>> Применено миграций: {len(applied)}." if applied else ">>> Схема актуальна.")
+
+
+@app.cli.command('db-status')
+def db_status_command():
+    """Показать примененные и ожидающие миграции."""
+    with db.engine.connect() as connection:
+        if not db.inspect(connection).has_table('schema_migrations'):
+            applied = {}
+        else:
+            applied = {row.version: row.applied_at for row in connection.execute(db.select(schema_migrations))}
+    for version, name, _, _ in sorted(MIGRATIONS, key=lambda item: item[0]):
+        print(f"{version:>4} {name:<40} {applied[version] if version in applied else 'pending'}")
+
+
+# --- Аудит планов запросов ---
+# Горячие запросы приложения с примерными параметрами. Если для какого-то из них
+# Postgres не может выбрать индекс даже при выключенном seq scan - индекс потерян или не подходит.
+def _hot_query_statements():
+    sample_user_id = 'query-plan-audit-user'
+    sample_time = datetime(2024, 1, 1)
+    return {
+        'archive_first_page': db.select(Prediction.id, Prediction.created_at, Prediction.output_url, Prediction.thumbnail_url)
+            .where(Prediction.user_id == sample_user_id, Prediction.status == 'completed')
+            .order_by(Prediction.created_at.desc(), Prediction.id.desc()).limit(ARCHIVE_PAGE_SIZE + 1),
+        'archive_next_page': db.select(Prediction.id, Prediction.created_at, Prediction.output_url, Prediction.thumbnail_url)
+            .where(Prediction.user_id == sample_user_id, Prediction.status == 'completed',
+                   db.or_(Prediction.created_at < sample_time,
+                          db.and_(Prediction.created_at == sample_time, Prediction.id < 'ffffffff')))
+            .order_by(Prediction.created_at.desc(), Prediction.id.desc()).limit(ARCHIVE_PAGE_SIZE + 1),
+        'account_delete_predictions': db.delete(Prediction).where(Prediction.user_id == sample_user_id),
+        'reconcile_pending': db.select(Prediction.replicate_id)
+            .where(Prediction.status == 'pending', Prediction.replicate_id.isnot(None))
+            .order_by(Prediction.created_at.desc()).limit(REPLICATE_RECONCILE_BATCH_SIZE),
+        'prediction_by_replicate_id': db.select(Prediction).where(Prediction.replicate_id == 'query-plan-audit'),
+        'user_by_stripe_subscription': db.select(User).where(User.stripe_subscription_id == 'sub_query_plan_audit'),
+        'user_by_stripe_customer': db.select(User).where(User.stripe_customer_id == 'cus_query_plan_audit'),
+    }
+
+
+def _seq_scanned_tables(plan):
+    tables = set()
+    if plan.get('Node Type') == 'Seq Scan':
+        tables.add(plan.get('Relation Name'))
+    for child in plan.get('Plans', []):
+        tables |= _seq_scanned_tables(child)
+    return tables
+
+
+def audit_query_plans():
+    """Возвращает {имя_запроса: [таблицы с seq scan]} для запросов, потерявших индекс."""
+    failures = {}
+    with db.engine.connect() as connection:
+        transaction = connection.begin()
+        try:
+            # Таблицы в тестовой базе маленькие, и планировщик честно выбрал бы seq scan.
+            # Запрещаем его: если seq scan остался, подходящего индекса просто нет.
+            connection.exec_driver_sql("SET LOCAL enable_seqscan = off")
+            for name, statement in _hot_query_statements().items():
+                compiled = statement.compile(dialect=connection.dialect)
+                explain = connection.exec_driver_sql(f"EXPLAIN (FORMAT JSON) {compiled}", compiled.params).scalar()
+                plan = (json.loads(explain) if isinstance(explain, str) else explain)[0]['Plan']
+                seq_scanned = _seq_scanned_tables(plan)
+                if seq_scanned:
+                    failures[name] = sorted(seq_scanned)
+        finally:
+            # EXPLAIN без ANALYZE ничего не выполняет, но DELETE все равно держим в откатываемой транзакции
+            transaction.rollback()
+    return failures
+
+
+@app.cli.command('audit-query-plans')
+def audit_query_plans_command():
+    """Проверка для CI: падает, если горячий запрос деградировал до seq scan."""
+    if db.engine.dialect.name != 'postgresql':
+        raise SystemExit("Query plan audit requires PostgreSQL (DATABASE_URL).")
+    failures = audit_query_plans()
+    for name in _hot_query_statements():
+        print(f"{'FAIL' if name in failures else 'ok  '} {name}" + (f" (seq scan on {', '.join(failures[name])})" if name in failures else ""))
+    if failures:
+        raise SystemExit(1)
+
+
+if BACKEND_MODE == 'local':
+    import local_backends
+    local_backends.install(sys.modules[__name__])
+
+# Необязательный прогрев клиентов в фоне сразу после старта воркера
+if SERVICES_PREWARM:
+    gevent.spawn(services.warm, None if SERVICES_PREWARM == 'all' else [name.strip() for name in SERVICES_PREWARM.split(',') if name.strip()])
 
 if __name__ == '__main__':
+    # Локальный запуск: схема докатывается сама, на проде это делает `flask db-upgrade`
+    with app.app_context():
+        run_migrations()
     app.run(debug=True, host='0.0.0.0', port=int(os.environ.get("PORT", 5001)))
@@ -0,0 +1,91 @@
+"""Замер холодного старта: сколько занимает `import app` в свежем интерпретаторе.
+
+Запуск из корня репозитория:
+
+    python benchmarks/import_time.py                  # текущее дерево
+    python benchmarks/import_time.py --compare HEAD~1 # плюс app.py из указанного git-ref
+
+Каждый прогон - отдельный процесс (как форк нового воркера gunicorn без preload).
+Дополнительно выводятся самые тяжелые модули по данным `python -X importtime`.
+"""
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _child_env(workdir):
+    env = dict(os.environ)
+    env.setdefault('DATABASE_URL', f"sqlite:///{os.path.join(workdir, 'import_bench.db')}")
+    env['PYTHONDONTWRITEBYTECODE'] = '1'
+    return env
+
+
+def measure(workdir, runs):
+    samples = []
+    for _ in range(runs):
+        started_at = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'import app'], cwd=workdir, env=_child_env(workdir), check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        samples.append((time.perf_counter() - started_at) * 1000)
+    return samples
+
+
+def heaviest_imports(workdir, top):
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'], cwd=workdir,
+                            env=_child_env(workdir), capture_output=True, text=True, check=True)
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # Только модули верхнего уровня: у вложенных импортов имя с дополнительным отступом
+        if not name.startswith('  '):
+            rows.append((int(cumulative), name.strip()))
+    return sorted(rows, reverse=True)[:top]
+
+
+def checkout_ref(ref, workdir):
+    source = subprocess.run(['git', 'show', f'{ref}:app.py'], cwd=REPO_ROOT, capture_output=True, text=True, check=True).stdout
+    with open(os.path.join(workdir, 'app.py'), 'w') as f:
+        f.write(source)
+
+
+def report(label, samples):
+    print(f"{label:<12} median {statistics.median(samples):8.1f} ms   "
+          f"min {min(samples):8.1f} ms   max {max(samples):8.1f} ms   (n={len(samples)})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--compare', metavar='GIT_REF', help='сравнить с app.py из этого git-ref')
+    parser.add_argument('--top', type=int, default=10, help='сколько тяжелых модулей показать')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as current_dir:
+        shutil.copy(os.path.join(REPO_ROOT, 'app.py'), current_dir)
+        current = measure(current_dir, args.runs)
+        report('current', current)
+
+        if args.compare:
+            with tempfile.TemporaryDirectory() as baseline_dir:
+                checkout_ref(args.compare, baseline_dir)
+                baseline = measure(baseline_dir, args.runs)
+                report(args.compare, baseline)
+                saved = statistics.median(baseline) - statistics.median(current)
+                print(f"{'':<12} saved  {saved:8.1f} ms per worker start")
+
+        print("\nHeaviest top-level imports (current, cumulative us):")
+        for cumulative_us, name in heaviest_imports(current_dir, args.top):
+            print(f"  {cumulative_us:>10}  {name}")
+
+
+if __name__ == '__main__':
+    main()
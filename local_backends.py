@@ -0,0 +1,439 @@
+"""Локальные заглушки внешних сервисов: Replicate, OpenAI, S3, Stripe и Firebase.
+
+Включаются переменной BACKEND_MODE=local. Тогда app.py регистрирует эти заглушки
+в своем реестре сервисов вместо настоящих SDK, и весь цикл
+отправка -> вебхук -> результат проходит на одной машине, без ключей и без лимитов вендоров.
+
+Настройка через окружение:
+    LOCAL_BACKEND_LATENCY_MS   задержки по сервисам, мс: "openai=400,replicate_run=3000,s3=20"
+    LOCAL_BACKEND_FAILURE_RATE доля отказов по сервисам: "replicate_run=0.05,openai=0.01"
+    LOCAL_OBJECT_STORE_DIR     каталог локального хранилища объектов (по умолчанию ./local_objects)
+
+Сервисы для задержек и отказов: openai, replicate (вызов API), replicate_run (сама генерация),
+s3, stripe, firebase, worker (генерация во внешнем воркере Autofix).
+
+Токен Firebase в локальном режиме имеет вид "local:<uid>" или "local:<uid>:<email>".
+
+Заглушки принимают любой токен "local:<uid>" и не проверяют подпись Stripe, поэтому
+install() отказывается работать рядом с боевым окружением: при DATABASE_URL на PostgreSQL
+не на локальном хосте или при настоящих ключах Stripe/Firebase. Одноразовую базу на
+другом хосте (например, для нагрузочного теста) можно разрешить явно:
+LOCAL_BACKENDS_ALLOW_DATABASE_URL=1. SQLite для нагрузочного теста не годится: ее
+блокировка записи под gevent выстраивает запросы в очередь.
+
+Статусы задач Replicate хранятся в памяти процесса, поэтому запускайте веб-приложение
+одним процессом (gunicorn -w 1 -k gevent). Вебхуки доставляются в любом случае.
+"""
+import json
+import logging
+import os
+import random
+import shutil
+import threading
+import time
+import uuid
+from types import SimpleNamespace
+from urllib.parse import urlsplit
+
+import requests
+from flask import Blueprint, abort, jsonify, send_file
+
+DEFAULT_LATENCY_MS = {
+    'openai': 400,
+    'replicate': 50,
+    'replicate_run': 3000,
+    's3': 20,
+    'stripe': 100,
+    'firebase': 5,
+    'worker': 5000,
+}
+LOCAL_OBJECT_STORE_DIR = os.environ.get('LOCAL_OBJECT_STORE_DIR', 'local_objects')
+# PostgreSQL на этих хостах (локальный сервер, docker compose) считаем тестовым
+LOCAL_DATABASE_HOSTS = {'localhost', '127.0.0.1', '::1', 'postgres', 'db'}
+LOCAL_BACKENDS_ALLOW_DATABASE_URL = os.environ.get('LOCAL_BACKENDS_ALLOW_DATABASE_URL') == '1'
+LOCAL_REPLICATE_HISTORY = 1000  # сколько последних задач отдавать в списке /v1/predictions
+
+log = logging.getLogger('pifly.local_backends')
+
+
+def _parse_service_map(raw, cast):
+    result = {}
+    for item in (raw or '').split(','):
+        if '=' in item:
+            name, value = item.split('=', 1)
+            result[name.strip()] = cast(value.strip())
+    return result
+
+
+class LocalBackendError(Exception):
+    """Искусственный отказ, вброшенный FaultInjector."""
+
+
+class FaultInjector:
+    """Задержка (±50% от заданной) и случайные отказы для вызова сервиса."""
+
+    def __init__(self, latency_ms, failure_rates):
+        self.latency_ms = latency_ms
+        self.failure_rates = failure_rates
+
+    @classmethod
+    def from_env(cls):
+        latency_ms = dict(DEFAULT_LATENCY_MS, **_parse_service_map(os.environ.get('LOCAL_BACKEND_LATENCY_MS'), float))
+        failure_rates = _parse_service_map(os.environ.get('LOCAL_BACKEND_FAILURE_RATE'), float)
+        return cls(latency_ms, failure_rates)
+
+    def __call__(self, service):
+        latency = self.latency_ms.get(service, 0) / 1000
+        if latency:
+            # После monkey.patch_all это gevent-sleep и не блокирует другие запросы
+            time.sleep(latency * random.uniform(0.5, 1.5))
+        if random.random() < self.failure_rates.get(service, 0):
+            raise LocalBackendError(f"Injected {service} failure")
+
+
+def _post_json_later(url, payload, delay, headers=None):
+    def deliver():
+        time.sleep(delay)
+        try:
+            requests.post(url, json=payload, headers=headers, timeout=30)
+        except requests.exceptions.RequestException as e:
+            log.warning("Локальный вебхук не доставлен", extra={'url': url, 'error': str(e)})
+    threading.Thread(target=deliver, daemon=True).start()
+
+
+# --- S3 ---
+class LocalObjectStore:
+    """Подмножество API boto3-клиента S3, которое использует S3Storage; объекты лежат на диске."""
+
+    def __init__(self, root, faults):
+        self.root = os.path.abspath(root)
+        self._faults = faults
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, key):
+        path = os.path.abspath(os.path.join(self.root, key))
+        if not path.startswith(self.root + os.sep):
+            raise ValueError(f"Invalid object key: {key}")
+        return path
+
+    def _write(self, key, fileobj):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'wb') as f:
+            shutil.copyfileobj(fileobj, f)
+        os.replace(tmp_path, path)
+
+    def upload_fileobj(self, fileobj, bucket, key, ExtraArgs=None, Config=None):
+        self._faults('s3')
+        self._write(key, fileobj)
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self._faults('s3')
+        path = self.path(Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(Body)
+        return {'ETag': uuid.uuid4().hex}
+
+    def head_object(self, Bucket, Key):
+        self._faults('s3')
+        if not os.path.exists(self.path(Key)):
+            from botocore.exceptions import ClientError
+            raise ClientError({'Error': {'Code': '404', 'Message': 'Not Found'}}, 'HeadObject')
+        return {'ContentLength': os.path.getsize(self.path(Key))}
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        upload_id = uuid.uuid4().hex
+        os.makedirs(os.path.join(self.root, '.multipart', upload_id))
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self._faults('s3')
+        with open(os.path.join(self.root, '.multipart', UploadId, f"{PartNumber:05d}"), 'wb') as f:
+            f.write(Body)
+        return {'ETag': f"{UploadId}-{PartNumber}"}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts_dir = os.path.join(self.root, '.multipart', UploadId)
+        path = self.path(Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as target:
+            for part in sorted(MultipartUpload['Parts'], key=lambda item: item['PartNumber']):
+                with open(os.path.join(parts_dir, f"{part['PartNumber']:05d}"), 'rb') as source:
+                    shutil.copyfileobj(source, target)
+        shutil.rmtree(parts_dir, ignore_errors=True)
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        shutil.rmtree(os.path.join(self.root, '.multipart', UploadId), ignore_errors=True)
+
+
+# --- OpenAI ---
+class LocalOpenAI:
+    """Отвечает детерминированно по тексту промпта, в формате ответа chat.completions."""
+
+    def __init__(self, faults):
+        self._faults = faults
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create_completion))
+
+    def _create_completion(self, model, messages, response_format=None, **kwargs):
+        self._faults('openai')
+        user_content = messages[-1]['content']
+        if isinstance(user_content, list):
+            user_content = ' '.join(part.get('text', '') for part in user_content if part.get('type') == 'text')
+        if response_format and response_format.get('type') == 'json_object':
+            content = json.dumps({'intent': 'REPLACE', 'mask_prompt': ' '.join(user_content.split()[:3]) or 'object'})
+        else:
+            content = f"Local rewrite: {user_content}"
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+
+# --- Replicate ---
+class LocalReplicate:
+    """predictions.create как у SDK replicate: результатом становится входная картинка,
+    а через задержку replicate_run на webhook приходит вебхук о завершении."""
+
+    def __init__(self, faults):
+        self._faults = faults
+        self._predictions = {}
+        self._lock = threading.Lock()
+        self.predictions = self
+
+    def create(self, version, input, webhook=None, webhook_events_filter=None):
+        self._faults('replicate')
+        replicate_id = f"local-{uuid.uuid4().hex}"
+        status_data = {
+            'id': replicate_id, 'version': version, 'input': input, 'status': 'starting',
+            'output': None, 'error': None, 'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        }
+        with self._lock:
+            self._predictions[replicate_id] = status_data
+            while len(self._predictions) > LOCAL_REPLICATE_HISTORY:
+                self._predictions.pop(next(iter(self._predictions)))
+        threading.Thread(target=self._run, args=(replicate_id, webhook), daemon=True).start()
+        return SimpleNamespace(id=replicate_id, status='starting')
+
+    def _run(self, replicate_id, webhook):
+        status_data = self._predictions.get(replicate_id)
+        if status_data is None:
+            return
+        status_data['status'] = 'processing'
+        try:
+            self._faults('replicate_run')
+            status_data['output'] = status_data['input'].get('input_image') or status_data['input'].get('image')
+            status_data['status'] = 'succeeded'
+        except LocalBackendError as e:
+            status_data['error'] = str(e)
+            status_data['status'] = 'failed'
+        if webhook:
+            _post_json_later(webhook, dict(status_data), 0)
+
+    def get(self, replicate_id):
+        return self._predictions.get(replicate_id)
+
+    def recent(self):
+        with self._lock:
+            return list(reversed(list(self._predictions.values())))
+
+
+# --- Stripe ---
+class _LocalStripeError(Exception):
+    pass
+
+
+class LocalStripe:
+    """Подмножество модуля stripe, которое использует приложение.
+
+    Оформление checkout сразу считается успешным: на /stripe-webhook уходит
+    checkout.session.completed. Подпись вебхука не проверяется.
+    """
+
+    def __init__(self, faults, stripe_webhook_url):
+        self._faults = faults
+        self._stripe_webhook_url = stripe_webhook_url
+        self._subscriptions = {}
+        self.error = SimpleNamespace(
+            InvalidRequestError=type('InvalidRequestError', (_LocalStripeError,), {}),
+            SignatureVerificationError=type('SignatureVerificationError', (_LocalStripeError,), {}),
+        )
+        self.checkout = SimpleNamespace(Session=SimpleNamespace(create=self._create_checkout_session))
+        self.billing_portal = SimpleNamespace(Session=SimpleNamespace(
+            create=lambda customer, return_url: SimpleNamespace(id=f"bps_local_{uuid.uuid4().hex}", url=return_url)))
+        self.Subscription = SimpleNamespace(retrieve=self._retrieve_subscription, modify=self._modify_subscription, cancel=self._cancel_subscription)
+        self.Webhook = SimpleNamespace(construct_event=lambda payload, sig_header, secret: json.loads(payload))
+
+    def _create_checkout_session(self, **params):
+        self._faults('stripe')
+        session_id = f"cs_local_{uuid.uuid4().hex}"
+        customer_id = params.get('customer') or f"cus_local_{uuid.uuid4().hex[:16]}"
+        subscription_id = None
+        if params.get('mode') == 'subscription':
+            subscription_id = f"sub_local_{uuid.uuid4().hex[:16]}"
+            trial_days = params.get('subscription_data', {}).get('trial_period_days')
+            now = int(time.time())
+            self._subscriptions[subscription_id] = SimpleNamespace(
+                id=subscription_id,
+                status='trialing' if trial_days else 'active',
+                trial_end=now + trial_days * 86400 if trial_days else None,
+                current_period_end=now + 30 * 86400,
+                cancel_at_period_end=False,
+                items=SimpleNamespace(data=[SimpleNamespace(price=SimpleNamespace(id=params['line_items'][0]['price']))]),
+            )
+        session = {
+            'id': session_id, 'object': 'checkout.session', 'mode': params.get('mode'),
+            'customer': customer_id, 'subscription': subscription_id,
+            'metadata': params.get('metadata', {}), 'line_items': params.get('line_items'),
+        }
+        _post_json_later(self._stripe_webhook_url, {'type': 'checkout.session.completed', 'data': {'object': session}}, 0.5)
+        return SimpleNamespace(id=session_id, url=params['success_url'].replace('{CHECKOUT_SESSION_ID}', session_id))
+
+    def _retrieve_subscription(self, subscription_id):
+        self._faults('stripe')
+        if subscription_id not in self._subscriptions:
+            raise self.error.InvalidRequestError(f"No such subscription: {subscription_id}")
+        return self._subscriptions[subscription_id]
+
+    def _modify_subscription(self, subscription_id, **params):
+        subscription = self._retrieve_subscription(subscription_id)
+        for key, value in params.items():
+            setattr(subscription, key, value)
+        return subscription
+
+    def _cancel_subscription(self, subscription_id):
+        subscription = self._retrieve_subscription(subscription_id)
+        subscription.status = 'canceled'
+        return subscription
+
+
+# --- Firebase ---
+class LocalFirebaseAuth:
+    def __init__(self, faults):
+        self._faults = faults
+
+    def verify_id_token(self, id_token):
+        self._faults('firebase')
+        parts = id_token.split(':')
+        if len(parts) < 2 or parts[0] != 'local' or not parts[1]:
+            raise ValueError("Local backend expects tokens of the form 'local:<uid>[:<email>]'")
+        uid = parts[1]
+        email = parts[2] if len(parts) > 2 else f"{uid}@local.test"
+        return {'uid': uid, 'email': email, 'name': uid, 'exp': int(time.time()) + 3600}
+
+    def delete_user(self, uid):
+        self._faults('firebase')
+
+
+# --- Воркер Autofix ---
+class LocalAutofixWorker:
+    """Заменяет внешний воркер: забирает задачи из очереди Autofix и отвечает на /worker-webhook."""
+
+    def __init__(self, app_module, faults):
+        self._app_module = app_module
+        self._faults = faults
+
+    def start(self):
+        threading.Thread(target=self.run_forever, name='local-autofix-worker', daemon=True).start()
+
+    def run_forever(self):
+        queue = self._app_module.edit_job_queue
+        while True:
+            try:
+                job = queue.claim(wait=5)
+                if job:
+                    threading.Thread(target=self._process, args=(job,), daemon=True).start()
+            except Exception as e:
+                log.warning("Локальный воркер Autofix: ошибка получения задачи", extra={'error': str(e)})
+                time.sleep(1)
+
+    def _process(self, job):
+        try:
+            self._faults('worker')
+            payload = {'prediction_id': job['prediction_id'], 'status': 'completed', 'final_url': job['original_s3_url']}
+        except LocalBackendError:
+            payload = {'prediction_id': job['prediction_id'], 'status': 'failed'}
+        base_url = (job.get('app_base_url') or self._app_module.APP_BASE_URL).rstrip('/')
+        _post_json_later(f"{base_url}/worker-webhook", payload, 0,
+                         headers={'Authorization': f"Bearer {self._app_module.WORKER_SECRET_KEY}"})
+
+
+def create_blueprint(store, replicate_backend):
+    blueprint = Blueprint('local_backends', __name__, url_prefix='/_local')
+
+    @blueprint.route('/objects/<path:key>')
+    def local_object(key):
+        try:
+            path = store.path(key)
+        except ValueError:
+            abort(404)
+        if not os.path.isfile(path):
+            abort(404)
+        return send_file(path)
+
+    @blueprint.route('/replicate/v1/predictions')
+    def local_replicate_list():
+        return jsonify({'results': replicate_backend.recent(), 'next': None})
+
+    @blueprint.route('/replicate/v1/predictions/<replicate_id>')
+    def local_replicate_get(replicate_id):
+        status_data = replicate_backend.get(replicate_id)
+        if status_data is None:
+            abort(404)
+        return jsonify(status_data)
+
+    return blueprint
+
+
+class UnsafeLocalBackends(RuntimeError):
+    """BACKEND_MODE=local включен в окружении, похожем на боевое."""
+
+
+def _production_signals(app_module):
+    signals = []
+    database_uri = app_module.app.config.get('SQLALCHEMY_DATABASE_URI') or ''
+    if database_uri.startswith(('postgres://', 'postgresql')) and not LOCAL_BACKENDS_ALLOW_DATABASE_URL:
+        host = urlsplit(database_uri).hostname or 'localhost'
+        if host not in LOCAL_DATABASE_HOSTS:
+            signals.append(f"DATABASE_URL points to PostgreSQL on {host} (set LOCAL_BACKENDS_ALLOW_DATABASE_URL=1 for a throwaway database)")
+    if app_module.STRIPE_SECRET_KEY or app_module.STRIPE_WEBHOOK_SECRET:
+        signals.append('Stripe credentials are set')
+    firebase_paths = [path for path in app_module.FIREBASE_CREDENTIAL_PATHS if os.path.exists(path)]
+    if firebase_paths:
+        signals.append(f"Firebase credentials found at {', '.join(firebase_paths)}")
+    if os.environ.get('GOOGLE_APPLICATION_CREDENTIALS'):
+        signals.append('GOOGLE_APPLICATION_CREDENTIALS is set')
+    return signals
+
+
+def install(app_module):
+    """Подменяет внешние сервисы в app.py локальными заглушками.
+
+    Бросает UnsafeLocalBackends, если окружение похоже на боевое: одной переменной
+    BACKEND_MODE недостаточно, чтобы отключить проверку токенов и подписей.
+    """
+    signals = _production_signals(app_module)
+    if signals:
+        raise UnsafeLocalBackends(
+            "BACKEND_MODE=local refuses to start with production settings: " + '; '.join(signals))
+    app, services = app_module.app, app_module.services
+    base_url = (app_module.APP_BASE_URL or 'http://localhost:5001').rstrip('/')
+    faults = FaultInjector.from_env()
+
+    store = LocalObjectStore(LOCAL_OBJECT_STORE_DIR, faults)
+    replicate_backend = LocalReplicate(faults)
+    services.register('openai')(lambda: LocalOpenAI(faults))
+    services.register('replicate')(lambda: replicate_backend)
+    services.register('stripe')(lambda: LocalStripe(faults, f"{base_url}/stripe-webhook"))
+    services.register('firebase_auth')(lambda: LocalFirebaseAuth(faults))
+    app_module.s3_storage.use_client(store, f"{base_url}/_local/objects")
+    app_module.replicate_status_poller.api_url = f"{base_url}/_local/replicate/v1"
+    app.register_blueprint(create_blueprint(store, replicate_backend))
+
+    if app_module.REDIS_URL:
+        # Локальному воркеру нужен общий секрет для /worker-webhook
+        app_module.WORKER_SECRET_KEY = app_module.WORKER_SECRET_KEY or 'local-worker-secret'
+        # Локальный воркер работает только по новому протоколу claim/heartbeat
+        app_module.edit_job_queue.mode = 'claim'
+        LocalAutofixWorker(app_module, faults).start()
+    log.warning("BACKEND_MODE=local: ВНЕШНИЕ СЕРВИСЫ ЗАМЕНЕНЫ ЗАГЛУШКАМИ. Любой токен local:<uid> проходит "
+                "аутентификацию, подпись Stripe не проверяется. Только для разработки и нагрузочных тестов.",
+                extra={'object_store': store.root})